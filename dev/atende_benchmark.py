@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Latency of the videobooth UploadProxy against the local stand-in Atende API (dev/atende_server.py):
+    - async_create_post -> result available (what RecordMovieState waits for)
+    - async_process of an already converted movie -> upload done
+Compare the pooled keep-alive session with a new connection per request (the old behaviour):
+    dev/atende_benchmark.py --latency-ms 150 --handshake-ms 450
+    dev/atende_benchmark.py --latency-ms 150 --handshake-ms 450 --no-keep-alive
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import config
+from videobooth import upload
+from atende_server import AtendeServer
+
+POLL_SECS = 0.005
+
+def percentile(values, pct):
+    """ nearest-rank percentile """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.))]
+
+def print_times(name, values):
+    print "%-20s n=%-3d p50=%7.1f ms  p90=%7.1f ms  max=%7.1f ms" % (name, len(values),
+        percentile(values, 50) * 1000, percentile(values, 90) * 1000, max(values) * 1000)
+
+def measure_create(proxy, count):
+    times = []
+    urls = []
+    for num in xrange(count):
+        start = time.time()
+        proxy.async_create_post("benchmark %d" % num)
+        result = None
+        while result is None:
+            time.sleep(POLL_SECS)
+            result = proxy.async_create_post_result()
+        times.append(time.time() - start)
+        urls.append(result[0])
+    return (times, urls)
+
+def measure_upload(proxy, archive_dir, urls, movie_size):
+    """ upload times of the successful uploads """
+    times = []
+    for num, upload_url in enumerate(urls):
+        filepath = os.path.join(archive_dir, "2000-01-01_00-00-%02d.mp4" % num)
+        with open(filepath, "wb") as movie:
+            movie.write(os.urandom(movie_size))
+
+        start = time.time()
+        proxy.async_process(upload_url, filepath)
+        proxy.upload_stage.join()
+        if os.path.exists(filepath + upload.DONE_SUFFIX):
+            times.append(time.time() - start)
+    return times
+
+def main():
+    """ main func """
+    logging.basicConfig(level=logging.WARN)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=10, help="number of movies")
+    parser.add_argument("--latency-ms", type=int, default=100, help="simulated RTT")
+    parser.add_argument("--handshake-ms", type=int, default=300, help="simulated TCP + TLS handshake")
+    parser.add_argument("--fail-rate", type=float, default=0., help="fraction of the requests failing with 503")
+    parser.add_argument("--movie-kb", type=int, default=1024, help="uploaded movie size")
+    parser.add_argument("--no-keep-alive", action="store_true", help="new connection for every request")
+    args = parser.parse_args()
+
+    server = AtendeServer(0, args.latency_ms, args.handshake_ms, args.fail_rate)
+    server.start_background()
+
+    archive_dir = tempfile.mkdtemp(prefix="atende_benchmark_")
+    conf = config.read_yaml(config.DEFAULT_CONFIG_FILE_VIDEO)
+    conf['picam']['archive_dir'] = archive_dir
+    conf['upload']['retrying'] = False
+    conf['upload']['atende']['api_endpoint'] = server.endpoint
+
+    proxy = upload.UploadProxy(conf)
+    if args.no_keep_alive:
+        proxy.http.headers['Connection'] = 'close'
+    proxy.start()
+
+    try:
+        (create_times, urls) = measure_create(proxy, args.count)
+        upload_times = measure_upload(proxy, archive_dir, [url for url in urls if url], args.movie_kb * 1024)
+    finally:
+        server.stop()
+        shutil.rmtree(archive_dir)
+
+    print "keep-alive: %s, RTT: %d ms, handshake: %d ms, fail rate: %.2f" % (not args.no_keep_alive,
+        args.latency_ms, args.handshake_ms, args.fail_rate)
+    print_times("async_create_post", create_times)
+    if upload_times:
+        print_times("upload (%d kB)" % args.movie_kb, upload_times)
+    print "failed creates: %d, failed uploads: %d" % (urls.count(""), len(urls) - urls.count("") - len(upload_times))
+    print "server: %s" % server.stats
+    print "upload stage: %s" % proxy.get_stats()['upload']
+
+if __name__ == '__main__':
+    main()
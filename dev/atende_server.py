@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Atende video API used by videobooth/upload.py:
+    POST /api/v1/videos/create/  -> JSON with uploadUri and frontendUri
+    PUT  <uploadUri>             -> 204 (the body is read and dropped)
+
+Poor connectivity is simulated by delays: every new connection pays the handshake time
+(TCP + TLS, a few RTTs), every request pays the latency (one RTT). Optionally a fraction
+of the requests fails with 503.
+usage: dev/atende_server.py [-p PORT] [--latency-ms MS] [--handshake-ms MS] [--fail-rate RATE]
+"""
+import argparse
+import BaseHTTPServer
+import itertools
+import json
+import random
+import socket
+import SocketServer
+import threading
+import time
+
+UPLOAD_PREFIX = "/api/v1/videos/upload/"
+READ_CHUNK = 64 * 1024
+
+class AtendeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ HTTP/1.1 with keep-alive, so the pooled connections can be reused """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stats['connections'] += 1
+        time.sleep(self.server.handshake_secs)
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def read_body(self):
+        remaining = int(self.headers.getheader('Content-Length') or 0)
+        while remaining > 0:
+            data = self.rfile.read(min(READ_CHUNK, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            self.server.stats['bytes_received'] += len(data)
+
+    def respond(self, code, body=""):
+        self.send_response(code)
+        if body:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, handler):
+        self.read_body()
+        time.sleep(self.server.latency_secs)
+        self.server.stats['requests'] += 1
+        if random.random() < self.server.fail_rate:
+            self.server.stats['failed'] += 1
+            self.respond(503)
+        else:
+            handler()
+
+    def do_POST(self):
+        self.handle_request(self.create)
+
+    def do_PUT(self):
+        self.handle_request(self.upload)
+
+    def create(self):
+        if self.path != "/api/v1/videos/create/":
+            return self.respond(404)
+        video_id = next(self.server.ids)
+        self.respond(200, json.dumps({
+            'uploadUri': "%s%d/" % (UPLOAD_PREFIX, video_id),
+            'frontendUri': "/video/%d/" % video_id,
+        }))
+
+    def upload(self):
+        if not self.path.startswith(UPLOAD_PREFIX):
+            return self.respond(404)
+        self.server.stats['uploads'] += 1
+        self.respond(204)
+
+
+class AtendeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ open keep-alive connections are tracked to be closed in stop() """
+
+    def __init__(self, port=0, latency_ms=0, handshake_ms=0, fail_rate=0., verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), AtendeHandler)
+        self.latency_secs = latency_ms / 1000.
+        self.handshake_secs = handshake_ms / 1000.
+        self.fail_rate = fail_rate
+        self.verbose = verbose
+        self.ids = itertools.count(1)
+        self.stats = dict(connections=0, requests=0, failed=0, uploads=0, bytes_received=0)
+        self.open_requests = set()
+
+    def process_request(self, request, client_address):
+        self.open_requests.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.open_requests.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def stop(self):
+        """ stops serving and wakes up the handler threads waiting for the next request """
+        self.shutdown()
+        for request in list(self.open_requests):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    @property
+    def endpoint(self):
+        return "http://%s:%d" % self.server_address
+
+    def start_background(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+
+def main():
+    """ main func """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=int, default=0, help="delay of every request (RTT)")
+    parser.add_argument("--handshake-ms", type=int, default=0, help="delay of every new connection (TCP + TLS)")
+    parser.add_argument("--fail-rate", type=float, default=0., help="fraction of the requests failing with 503")
+    args = parser.parse_args()
+
+    server = AtendeServer(args.port, args.latency_ms, args.handshake_ms, args.fail_rate, verbose=True)
+    print "serving on %s (set it as upload.atende.api_endpoint)" % server.endpoint
+    server.start_background()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+        print server.stats
+
+if __name__ == '__main__':
+    main()
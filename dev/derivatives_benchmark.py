@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Comparing creation of scaled images from full-size capture:
+full-size pygame decode + transform.scale vs PIL shrink-on-load (draft mode).
+Every method runs in a fresh process to measure its peak RSS.
+"""
+import multiprocessing
+import resource
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from photobooth import derivatives
+
+REPEAT = 5
+
+def measure(method_name, file_name, results):
+    """ run in separate process """
+    method = getattr(derivatives, method_name)
+    start = time.time()
+    for _ in xrange(REPEAT):
+        method(file_name)
+    elapsed = (time.time() - start) / REPEAT
+    # ru_maxrss is in kilobytes on linux
+    results.put((method_name, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+def main():
+    """ main func """
+    file_name = sys.argv[1] if len(sys.argv) > 1 else "dev/dummy-capture.jpg"
+    print "image: %s" % file_name
+
+    results = multiprocessing.Queue()
+    for method_name in ["scale_full", "scale_draft"]:
+        proc = multiprocessing.Process(target=measure, args=(method_name, file_name, results))
+        proc.start()
+        proc.join()
+        name, elapsed, max_rss = results.get()
+        print "%-12s time per shot = %f s, peak RSS = %.1f MB" % (name, elapsed, max_rss)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Comparing session GIF creation: built-in encoder (from raw frames in memory and from the JPEGs)
+vs ImageMagick 'convert' subprocess (the old way).
+usage: dev/gif_benchmark.py [session_dir]  (without session_dir 4 test images are generated)
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageFilter
+from photobooth import gif
+from photobooth.view import LivePreview
+
+DELAY_MS = 250
+REPEAT = 3
+
+def generate_session(sess_dir):
+    """ 4 medium images from the dummy capture (different blur, like DummyCamera does) """
+    base = Image.open("dev/dummy-capture.jpg").convert("RGB").resize((LivePreview.WIDTH, LivePreview.HEIGHT), Image.ANTIALIAS)
+    for num in xrange(1, 5):
+        base.filter(ImageFilter.GaussianBlur((4 - num) * 2)).save(os.path.join(sess_dir, "%d_medium.jpg" % num))
+
+def measure(name, func, out_name):
+    start = time.time()
+    for _ in xrange(REPEAT):
+        func()
+    elapsed = (time.time() - start) / REPEAT
+    print "%-20s time = %f s, size = %d kB" % (name, elapsed, os.path.getsize(out_name) / 1024)
+
+def main():
+    """ main func """
+    tmp_dir = tempfile.mkdtemp(prefix="gif_benchmark_")
+    sess_dir = sys.argv[1] if len(sys.argv) > 1 else tmp_dir
+    if sess_dir == tmp_dir:
+        generate_session(sess_dir)
+    img_list = [os.path.join(sess_dir, "%d_medium.jpg" % num) for num in xrange(1, 5)]
+
+    # what the booth sends to the uploader: raw RGB of the medium surfaces
+    images = gif.frames_from_files(img_list)
+    raw_frames = (images[0].size, [img.tobytes() for img in images])
+
+    try:
+        out_name = os.path.join(tmp_dir, "memory.gif")
+        measure("encoder (memory)", lambda: gif.write(out_name, gif.frames_from_raw(*raw_frames), DELAY_MS), out_name)
+
+        out_name = os.path.join(tmp_dir, "files.gif")
+        measure("encoder (JPEGs)", lambda: gif.write(out_name, gif.frames_from_files(img_list), DELAY_MS), out_name)
+
+        out_name = os.path.join(tmp_dir, "convert.gif")
+        cmd = ["convert", "-delay", str(DELAY_MS / 10), "-loop", "0"] + img_list + [out_name]
+        try:
+            measure("convert (subprocess)", lambda: subprocess.check_call(cmd), out_name)
+        except OSError:
+            print "convert (subprocess) not available"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -342,8 +342,8 @@ class GifWriter:
             Y = np.argwhere(diff.sum(1))
             # Get rect coordinates
             if X.size and Y.size:
-                x0, x1 = X[0], X[-1]+1
-                y0, y1 = Y[0], Y[-1]+1
+                x0, x1 = int(X[0]), int(X[-1])+1
+                y0, y1 = int(Y[0]), int(Y[-1])+1
             else: # No change ... make it minimal
                 x0, x1 = 0, 2
                 y0, y1 = 0, 2
@@ -360,11 +360,12 @@ class GifWriter:
         return ims2, xy
 
 
-    def convertImagesToPIL(self, images, dither, nq=0):
-        """ convertImagesToPIL(images, nq=0)
+    def convertImagesToPIL(self, images, dither, nq=0, quantizer=None):
+        """ convertImagesToPIL(images, nq=0, quantizer=None)
 
         Convert images to Paletted PIL images, which can then be
-        written to a single animaged GIF.
+        written to a single animaged GIF. The quantizer class is used
+        if nq is nonzero (KMeansQuant by default).
 
         """
 
@@ -385,10 +386,11 @@ class GifWriter:
         # Convert to paletted PIL images
         images, images2 = images2, []
         if nq >= 1:
-            # NeuQuant algorithm
+            # NeuQuant algorithm (or compatible quantizer)
+            quantizer = quantizer or KMeansQuant
             for im in images:
                 im = im.convert("RGBA") # NQ assumes RGBA
-                nqInstance = NeuQuant(im, int(nq)) # Learn colors from image
+                nqInstance = quantizer(im, int(nq)) # Learn colors from image
                 if dither:
                     im = im.convert("RGB").quantize(palette=nqInstance.paletteImage())
                 else:
@@ -453,8 +455,11 @@ class GifWriter:
                 # Write palette and image data
 
                 # Gather info
-                data = getdata(im)
+                data = getdata(im, interlace=False)
                 imdes, data = data[0], data[1:]
+                if len(imdes) == 10:
+                    # newer PIL returns LZW minimum size code as a separate chunk
+                    imdes, data = imdes + data[0], data[1:]
                 graphext = self.getGraphicsControlExt(durations[frames],
                                                         disposes[frames])
                 # Make image descriptor suitable for using 256 local color palette
@@ -488,9 +493,9 @@ class GifWriter:
 ## Exposed functions
 
 def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
-                nq=0, subRectangles=True, dispose=None):
+                nq=0, subRectangles=True, dispose=None, quantizer=None):
     """ writeGif(filename, images, duration=0.1, repeat=True, dither=False,
-                    nq=0, subRectangles=True, dispose=None)
+                    nq=0, subRectangles=True, dispose=None, quantizer=None)
 
     Write an animated gif from the specified images.
 
@@ -515,6 +520,9 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
         parameter. 1 represents the best quality. 10 is in general a
         good tradeoff between quality and speed. When using this option,
         better results are usually obtained when subRectangles is False.
+    quantizer : class
+        Quantizer used if nq is nonzero: KMeansQuant (default, vectorized)
+        or NeuQuant (the original pure Python neural net, slow).
     subRectangles : False, True, or a list of 2-element tuples
         Whether to use sub-rectangles. If True, the minimal rectangle that
         is required to update each frame is automatically detected. This
@@ -577,7 +585,7 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
 
 
     # Make images in a format that we can write easy
-    images = gifWriter.convertImagesToPIL(images, dither, nq)
+    images = gifWriter.convertImagesToPIL(images, dither, nq, quantizer)
 
     # Write
     fp = open(filename, 'wb')
@@ -768,7 +776,7 @@ class NeuQuant:
 
         # Initialize
         self.setconstants(samplefac, colors)
-        self.pixels = np.fromstring(image.tostring(), np.uint32)
+        self.pixels = np.fromstring(image.tobytes(), np.uint32)
         self.setUpArrays()
 
         self.learn()
@@ -1040,21 +1048,13 @@ class NeuQuant:
 
     def quantize_without_scipy(self, image):
         """" This function can be used if no scipy is availabe.
-        It's 7 times slower though.
+        Vectorized nearest palette lookup.
         """
         w,h = image.size
-        px = np.asarray(image).copy()
-        memo = {}
-        for j in range(w):
-            for i in range(h):
-                key = (px[i,j,0],px[i,j,1],px[i,j,2])
-                try:
-                    val = memo[key]
-                except KeyError:
-                    val = self.convert(*key)
-                    memo[key] = val
-                px[i,j,0],px[i,j,1],px[i,j,2] = val
-        return Image.fromarray(px).convert("RGB").quantize(palette=self.paletteImage())
+        px = np.asarray(image)[:,:,:3].reshape((w*h,3))
+        indices = nearestPaletteIndices(px, self.colormap[:,:3])
+        px = self.colormap[indices,:3].astype(np.uint8).reshape((h,w,3))
+        return Image.fromarray(px, "RGB").quantize(palette=self.paletteImage())
 
     def convert(self, *color):
         i = self.inxsearch(*color)
@@ -1068,6 +1068,135 @@ class NeuQuant:
 
 
 
+def nearestPaletteIndices(pixels, palette, chunk=65536):
+    """ nearestPaletteIndices(pixels, palette, chunk=65536)
+
+    Vectorized nearest color lookup: for every row of pixels (N x 3)
+    returns index of the closest (euclidean) row of palette (K x 3).
+    Pixels are processed in chunks to bound the N x K distance matrix.
+
+    """
+    palette = np.asarray(palette, dtype=np.float32)
+    palette_sq = (palette * palette).sum(1)
+    result = np.empty(len(pixels), dtype=np.intp)
+    for start in range(0, len(pixels), chunk):
+        px = np.asarray(pixels[start:start+chunk], dtype=np.float32)
+        # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, |p|^2 does not change the argmin
+        dists = palette_sq - 2 * px.dot(palette.T)
+        result[start:start+chunk] = dists.argmin(1)
+    return result
+
+
+class KMeansQuant:
+    """ KMeansQuant(image, samplefac=10, colors=256)
+
+    Vectorized (NumPy) color quantizer with the NeuQuant interface
+    (colormap, paletteImage, quantize, convert, inxsearch), so it can
+    be used in place of it.
+
+    Every samplefac-th pixel is taken, the sampled set is divided by
+    median cut and the resulting colors are refined by a few batched
+    k-means (Lloyd) iterations. Quantizing the image is a single
+    vectorized nearest palette lookup.
+
+    """
+
+    ITERATIONS = 6
+
+    def __init__(self, image, samplefac=10, colors=256):
+
+        # Check Numpy
+        if np is None:
+            raise RuntimeError("Need Numpy for the KMeansQuant algorithm.")
+
+        self.NETSIZE = colors
+        self.samplefac = samplefac
+        self.pimage = None
+
+        pixels = np.asarray(image.convert("RGB")).reshape(-1, 3)
+        sample = pixels[::max(1, int(samplefac))].astype(np.float32)
+
+        network = self.medianCut(sample)
+        for i in range(self.ITERATIONS):
+            network = self.refine(sample, network)
+
+        self.colormap = np.empty((self.NETSIZE, 4), dtype='int32')
+        self.colormap[:,:3] = np.clip(np.round(network), 0, 255)
+        self.colormap[:,3] = np.arange(self.NETSIZE)
+
+    def medianCut(self, sample):
+        """ initial colors: means of the boxes from splitting the biggest
+        box (color range) at the median of its widest channel """
+        boxes = [sample]
+        ranges = [np.ptp(sample, 0)]
+        widest = [ranges[0].max()]
+        while len(boxes) < self.NETSIZE:
+            i = int(np.argmax(widest))
+            if widest[i] <= 0:
+                break # less colors than NETSIZE
+
+            box = boxes.pop(i)
+            widest.pop(i)
+            channel = int(np.argmax(ranges.pop(i)))
+            order = box[:, channel].argsort(kind='mergesort')
+            half = len(box) // 2
+            for part in (box[order[:half]], box[order[half:]]):
+                boxes.append(part)
+                ranges.append(np.ptp(part, 0))
+                widest.append(ranges[-1].max())
+
+        network = np.zeros((self.NETSIZE, 3), dtype=np.float32)
+        network[:len(boxes)] = [box.mean(0) for box in boxes]
+        return network
+
+    def refine(self, sample, network):
+        """ single k-means iteration: move every color to the mean of its pixels """
+        indices = nearestPaletteIndices(sample, network)
+        counts = np.bincount(indices, minlength=self.NETSIZE)
+        used = counts > 0
+        for channel in range(3):
+            sums = np.bincount(indices, weights=sample[:, channel], minlength=self.NETSIZE)
+            network[used, channel] = sums[used] / counts[used]
+        return network
+
+    def writeColourMap(self, rgb, outstream):
+        for i in range(self.NETSIZE):
+            bb = self.colormap[i,0];
+            gg = self.colormap[i,1];
+            rr = self.colormap[i,2];
+            outstream.write(rr if rgb else bb)
+            outstream.write(gg)
+            outstream.write(bb if rgb else rr)
+        return self.NETSIZE
+
+    def paletteImage(self):
+        """ palette image to be used with Image.quantize (see NeuQuant) """
+        if self.pimage is None:
+            palette = self.colormap[:,:3].ravel().tolist()
+            palette.extend([0]*(256-self.NETSIZE)*3)
+            self.pimage = Image.new("P", (1, 1), 0)
+            self.pimage.putpalette(palette)
+        return self.pimage
+
+    def quantize(self, image):
+        """ paletted image, without dithering """
+        w,h = image.size
+        px = np.asarray(image.convert("RGB")).reshape(-1, 3)
+        indices = nearestPaletteIndices(px, self.colormap[:,:3])
+        im = Image.fromarray(indices.astype(np.uint8).reshape(h, w), "L").convert("P")
+        im.putpalette(self.paletteImage().getpalette())
+        return im
+
+    def convert(self, *color):
+        i = self.inxsearch(*color)
+        return self.colormap[i,:3]
+
+    def inxsearch(self, r, g, b):
+        """Search for RGB values 0..255 and return colour index"""
+        return nearestPaletteIndices([[r, g, b]], self.colormap[:,:3])[0]
+
+
+
 if __name__ == '__main__':
     im = np.zeros((200,200), dtype=np.uint8)
     im[10:30,:] = 100
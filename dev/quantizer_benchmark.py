@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Benchmarking images2gif.writeGif with different quantizers on the session images:
+PIL adaptive palette (nq=0), vectorized KMeansQuant and the original NeuQuant.
+Reports time and mean per-pixel error of the quantized frames.
+usage: dev/quantizer_benchmark.py [-s SCALE] [--skip-neuquant] [session_dir]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import images2gif
+import gif_benchmark
+
+NQ_SAMPLEFAC = 10
+
+class Mute(object):
+    """ NeuQuant prints its learning progress """
+    def write(self, data):
+        pass
+
+def mean_error(gif_name, images):
+    """ mean absolute difference of the first frame (later frames are cut into sub-rectangles) """
+    decoded = np.asarray(Image.open(gif_name).convert("RGB"), dtype=float)
+    return np.abs(decoded - np.asarray(images[0], dtype=float)).mean()
+
+def measure(name, gif_name, images, **kwargs):
+    stdout, sys.stdout = sys.stdout, Mute()
+    try:
+        start = time.time()
+        images2gif.writeGif(gif_name, list(images), duration=0.25, **kwargs)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+    print "%-14s time = %8.3f s, size = %5d kB, mean error = %.2f" % (name, elapsed,
+        os.path.getsize(gif_name) / 1024, mean_error(gif_name, images))
+
+def main():
+    """ main func """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("session_dir", nargs="?", help="directory with [1-4]_medium.jpg (default: generated)")
+    parser.add_argument("-s", "--scale", type=float, default=0.5, help="frames scale (NeuQuant is really slow on full medium images)")
+    parser.add_argument("--skip-neuquant", action="store_true")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="quantizer_benchmark_")
+    sess_dir = args.session_dir or tmp_dir
+    if not args.session_dir:
+        gif_benchmark.generate_session(sess_dir)
+
+    images = [Image.open(os.path.join(sess_dir, "%d_medium.jpg" % num)).convert("RGB") for num in xrange(1, 5)]
+    size = (int(images[0].size[0] * args.scale), int(images[0].size[1] * args.scale))
+    images = [img.resize(size, Image.ANTIALIAS) for img in images]
+    print "4 frames %dx%d" % size
+
+    gif_name = os.path.join(tmp_dir, "out.gif")
+    try:
+        measure("PIL adaptive", gif_name, images, nq=0)
+        measure("KMeansQuant", gif_name, images, nq=NQ_SAMPLEFAC, quantizer=images2gif.KMeansQuant)
+        if not args.skip_neuquant:
+            measure("NeuQuant", gif_name, images, nq=NQ_SAMPLEFAC, quantizer=images2gif.NeuQuant)
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+if __name__ == '__main__':
+    main()
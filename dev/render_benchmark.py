@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Headless benchmark of the whole render loop: PhotoBoothController with SyntheticCamera
+(in-memory live view frames at a given rate) on the SDL dummy video driver.
+Runs complete sessions with scripted button presses and reports:
+    - frame time percentiles (render work per frame, interval between frames on the working screen)
+    - capture-to-preview latencies (shutter -> small preview shown): instant one from the embedded
+      EXIF thumbnail (with --embedded-preview) and the full-quality one
+    - CPU time per subsystem (thread CPU time spent in the instrumented calls)
+
+Run from the repository root (assets are loaded from relative paths), eg. on the Pi before the event:
+    dev/render_benchmark.py -n 3 events/my_event
+"""
+import argparse
+import ctypes
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+from common import config
+from photobooth import camera
+from photobooth import controller
+from photobooth import model
+
+CLOCK_THREAD_CPUTIME_ID = 3
+IDLE_WAIT_SECS = 1
+
+class Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+librt = ctypes.CDLL("librt.so.1", use_errno=True)
+
+def thread_cpu_time():
+    """ CPU time of the calling thread in seconds """
+    spec = Timespec()
+    librt.clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(spec))
+    return spec.tv_sec + spec.tv_nsec * 1e-9
+
+def percentile(values, pct):
+    """ nearest-rank percentile """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.))]
+
+
+class Probe(object):
+    """ wall and thread CPU time of every call of the instrumented method """
+    probes = []
+
+    def __init__(self, name, obj, method_name):
+        self.name = name
+        self.walls = []
+        self.cpu = 0.
+        self.method = getattr(obj, method_name)
+        setattr(obj, method_name, self)
+        Probe.probes.append(self)
+
+    def __call__(self, *args, **kwargs):
+        start_wall = time.time()
+        start_cpu = thread_cpu_time()
+        try:
+            return self.method(*args, **kwargs)
+        finally:
+            self.cpu += thread_cpu_time() - start_cpu
+            self.walls.append(time.time() - start_wall)
+
+
+class BenchmarkController(controller.PhotoBoothController):
+    """ presses the button by itself, measures frames and capture latencies """
+
+    def __init__(self, conf, cam, sessions_cnt):
+        super(BenchmarkController, self).__init__(conf, cam)
+        self.sessions_cnt = sessions_cnt
+        self.sessions_done = 0
+        self.idle_since = time.time()
+        self.last_frame = None
+        self.frame_intervals = []
+        self.shutter_times = dict()
+        self.latencies = []
+        self.instant_latencies = []
+
+        render_embedded_preview = self.derivatives.render_embedded_preview
+        def timed_embedded_preview(image_names):
+            img = render_embedded_preview(image_names)
+            if img:
+                self.instant_latencies.append(time.time() - self.shutter_times[image_names[0]])
+            return img
+        self.derivatives.render_embedded_preview = timed_embedded_preview
+
+        Probe("render (view.update)", self.view, "update")
+        Probe("  live view frames", cam, "capture_preview")
+        Probe("model (state machine)", self.model, "update")
+        Probe("capture (camera)", cam, "capture_image")
+        Probe("post-processing", self, "process_captured_image")
+
+    def process_events(self):
+        button_pressed = super(BenchmarkController, self).process_events()
+        now = time.time()
+
+        # working screen frame intervals (idle screen sleeps on purpose)
+        if not self.view.idle and self.last_frame:
+            self.frame_intervals.append(now - self.last_frame)
+        self.last_frame = now
+
+        sess = self.model.current_sess
+        if sess is None:
+            if self.sessions_done == self.sessions_cnt:
+                self.is_running = False
+            elif now - self.idle_since > IDLE_WAIT_SECS:
+                button_pressed = True # wake up from the idle screen
+        elif isinstance(sess.state, model.WaitingState):
+            button_pressed = True # start the countdown
+        return button_pressed
+
+    def capture_image(self, image_number, file_paths):
+        self.shutter_times[file_paths[0]] = time.time()
+        super(BenchmarkController, self).capture_image(image_number, file_paths)
+
+    def process_captured_image(self, image_number, image_name, medium_name, prev_name):
+        result = super(BenchmarkController, self).process_captured_image(image_number, image_name, medium_name, prev_name)
+        self.latencies.append(time.time() - self.shutter_times[image_name])
+        return result
+
+    def notify_finished_session(self, sess):
+        super(BenchmarkController, self).notify_finished_session(sess)
+        self.sessions_done += 1
+        self.idle_since = time.time() + self.conf['control']['montage_display_secs']
+
+
+def print_times(name, values):
+    print "%-28s n=%-5d p50=%7.1f ms  p90=%7.1f ms  p99=%7.1f ms  max=%7.1f ms" % (name, len(values),
+        percentile(values, 50) * 1000, percentile(values, 90) * 1000, percentile(values, 99) * 1000,
+        max(values or [float('nan')]) * 1000)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("event_dir", nargs="?", help="event directory with config.yaml (default: temporary copy of the template)")
+    parser.add_argument("-n", "--sessions", type=int, default=2, help="number of complete sessions")
+    parser.add_argument("--fps", type=int, help="synthetic live view frames rate")
+    parser.add_argument("--capture-ms", type=int, help="simulated capture duration")
+    parser.add_argument("--embedded-preview", action="store_true", help="show the EXIF thumbnail first")
+    parser.add_argument("--montage-secs", type=int, default=3, help="shortened session montage display time")
+    return parser.parse_args()
+
+def main():
+    """ main func """
+    logging.basicConfig(level=logging.WARN)
+    args = parse_args()
+
+    tmp_dir = None
+    event_dir = args.event_dir
+    if not event_dir:
+        tmp_dir = tempfile.mkdtemp(prefix="render_benchmark_")
+        shutil.copy(config.DEFAULT_CONFIG_FILE, tmp_dir)
+        event_dir = tmp_dir
+
+    conf = config.read_config(event_dir)
+    conf['event_dir'] = event_dir
+    conf['control']['save_path'] = event_dir
+    conf['camera']['driver'] = "SyntheticCamera"
+    if args.fps:
+        conf['camera']['synthetic_fps'] = args.fps
+    if args.capture_ms is not None:
+        conf['camera']['synthetic_capture_ms'] = args.capture_ms
+    conf['control']['montage_display_secs'] = args.montage_secs
+    conf['control']['embedded_preview'] = args.embedded_preview
+    conf['display']['fullscreen'] = False
+    conf['upload']['enabled'] = False
+    conf['printer']['driver'] = "NullPrinter"
+
+    cam = camera.SyntheticCamera(conf)
+    booth = BenchmarkController(conf, cam, args.sessions)
+    start = time.time()
+    try:
+        booth.run()
+    finally:
+        booth.quit()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+    elapsed = time.time() - start
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN) # derivatives processes, reaped in quit()
+
+    print "display driver: %s, sessions: %d, elapsed: %.1f s" % (os.environ["SDL_VIDEODRIVER"], args.sessions, elapsed)
+    print "live view source: %d FPS, frames: %s" % (conf['camera']['synthetic_fps'], cam.get_preview_stats())
+    print
+    print_times("render work per frame", booth.view.update.walls)
+    print_times("frame interval (working)", booth.frame_intervals)
+    print_times("capture-to-instant-preview", booth.instant_latencies)
+    print_times("capture-to-full-preview", booth.latencies)
+    print
+    print "CPU time per subsystem:"
+    for probe in Probe.probes:
+        print "    %-28s %7.2f s (%4.1f%%)" % (probe.name, probe.cpu, probe.cpu / elapsed * 100)
+    print "    %-28s %7.2f s (%4.1f%%)" % ("derivatives processes", usage_children.ru_utime + usage_children.ru_stime,
+                                          (usage_children.ru_utime + usage_children.ru_stime) / elapsed * 100)
+    print "    %-28s %7.2f s (%4.1f%%)" % ("main process total", usage_self.ru_utime + usage_self.ru_stime,
+                                          (usage_self.ru_utime + usage_self.ru_stime) / elapsed * 100)
+
+if __name__ == '__main__':
+    main()
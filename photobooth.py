@@ -80,7 +80,7 @@ def main():
     try:
         # setup PRINTER
         camera_class = getattr(importlib.import_module("photobooth.camera"), conf['camera']['driver'])
-        cam = camera_class()
+        cam = camera_class(conf)
     except ValueError:
         logger.exception("Camera could not be initialised, exiting!")
         sys.exit(-1)
@@ -0,0 +1,49 @@
+# encoding: utf-8
+"""
+Single timeline for all of the preview animations.
+
+The clock is ticked once per rendered frame, every animation advances with its own FPS
+counted from that common time, so the speed does not depend on the render loop FPS and
+the main loop can sleep until the next animation frame is due.
+"""
+import pygame
+
+class AnimationClock(object):
+    """ keeps the next frame due time of every running animation """
+
+    def __init__(self):
+        self.now = 0
+        self.animations = dict() # animation -> [next frame due ticks, frame interval ms]
+
+    def tick(self):
+        """ update the common time, called once per rendered frame """
+        self.now = pygame.time.get_ticks()
+
+    def start(self, anim, fps):
+        """ first frame is due immediately """
+        self.animations[anim] = [self.now, 1000. / fps]
+
+    def stop(self, anim):
+        self.animations.pop(anim, None)
+
+    def is_due(self, anim):
+        """ True if the next frame of the animation should be shown now (schedules the following one) """
+        entry = self.animations.get(anim)
+        if not entry or entry[0] > self.now:
+            return False
+
+        entry[0] += entry[1]
+        if entry[0] <= self.now: # we're late (eg. display was busy) - skip frames instead of catching up
+            entry[0] = self.now + entry[1]
+        return True
+
+    def time_to_next_due(self, anims):
+        """ milliseconds to the next frame of any of the given animations or None if none is running """
+        due_times = [self.animations[anim][0] for anim in anims if anim in self.animations]
+        if not due_times:
+            return None
+        return max(0, int(min(due_times)) - pygame.time.get_ticks())
+
+
+# process-wide clock used by all previews
+clock = AnimationClock()
@@ -0,0 +1,80 @@
+# encoding: utf-8
+"""
+Shared store of the animation frames (shutter overlay).
+
+Every frame sequence is loaded and converted only once and shared by all of the previews.
+Optionally the decoded pixels are cached in a raw file next to the PNGs, so the next startups
+skip PNG decoding altogether (trading CPU time for much bigger file to read).
+"""
+import os
+import struct
+
+import pygame
+
+import logging
+logger = logging.getLogger('photobooth.%s' % __name__)
+
+RAW_CACHE_HEADER = "<4sIII" # magic, frames count, width, height
+RAW_CACHE_MAGIC = "RGBA"
+
+animations = dict()
+
+def get_raw_cache_filename(file_glob, begin, end):
+    return os.path.join(os.path.dirname(file_glob % begin), ".frames_%02d_%02d.rgba" % (begin, end))
+
+def load_frames(file_glob, begin, end, raw_cache=False):
+    """ list of converted frames [begin, end) of the animation, loaded only once """
+    key = (file_glob, begin, end)
+    if key not in animations:
+        file_names = [file_glob % i for i in xrange(begin, end)]
+        cache_name = get_raw_cache_filename(file_glob, begin, end)
+        images = read_raw_cache(cache_name, file_names) if raw_cache else None
+        if images is None:
+            images = [pygame.image.load(name) for name in file_names]
+            if raw_cache:
+                write_raw_cache(cache_name, images)
+
+        animations[key] = [img.convert_alpha() for img in images]
+    return animations[key]
+
+def read_raw_cache(cache_name, file_names):
+    """ returns list of surfaces from raw cache or None if it does not exist or is outdated """
+    try:
+        if os.path.getmtime(cache_name) < max(os.path.getmtime(name) for name in file_names):
+            return None
+        with open(cache_name, 'rb') as cache_file:
+            data = cache_file.read()
+    except (OSError, IOError):
+        return None
+
+    header_size = struct.calcsize(RAW_CACHE_HEADER)
+    if len(data) < header_size:
+        logger.warn("invalid frames cache: %s", cache_name)
+        return None
+    magic, count, width, height = struct.unpack_from(RAW_CACHE_HEADER, data)
+    frame_size = width * height * 4
+    if magic != RAW_CACHE_MAGIC or count != len(file_names) or len(data) != header_size + count * frame_size:
+        logger.warn("invalid frames cache: %s", cache_name)
+        return None
+
+    return [pygame.image.fromstring(data[header_size + i * frame_size:header_size + (i + 1) * frame_size],
+                                    (width, height), "RGBA") for i in xrange(count)]
+
+def write_raw_cache(cache_name, images):
+    """
+    saving decoded frames, failing silently (eg. on read-only filesystem);
+    written to a temporary file first, so a crash never leaves a partial cache
+    """
+    width, height = images[0].get_size()
+    if any(img.get_size() != (width, height) for img in images):
+        return
+
+    tmp_name = cache_name + ".tmp"
+    try:
+        with open(tmp_name, 'wb') as cache_file:
+            cache_file.write(struct.pack(RAW_CACHE_HEADER, RAW_CACHE_MAGIC, len(images), width, height))
+            for img in images:
+                cache_file.write(pygame.image.tostring(img, "RGBA"))
+        os.rename(tmp_name, cache_name)
+    except (OSError, IOError):
+        logger.warn("could not write frames cache: %s", cache_name)
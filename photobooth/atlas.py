@@ -0,0 +1,73 @@
+# encoding: utf-8
+"""
+Idle screen preview atlases.
+
+All of the session 'prev' images are packed into a single image (stored in the session directory),
+so showing the session on the idle screen needs only one decode and one surface.
+The atlas is stored as PNG - the previews are already JPEGs, re-encoding them would lose quality again.
+Single previews are subsurfaces of the atlas - they share its pixels.
+"""
+from collections import OrderedDict
+import os
+
+import pygame
+
+import logging
+logger = logging.getLogger('photobooth.%s' % __name__)
+
+ATLAS_FILENAME = "prev_atlas.png"
+
+def get_atlas_filename(sess_dir):
+    return os.path.join(sess_dir, ATLAS_FILENAME)
+
+def pack(images):
+    """ packs images side by side, returns (atlas surface, list of [x, y, w, h] rects) """
+    width = sum(img.get_width() for img in images)
+    height = max(img.get_height() for img in images)
+    atlas = pygame.Surface((width, height)).convert()
+
+    rects = []
+    left = 0
+    for img in images:
+        atlas.blit(img, (left, 0))
+        rects.append([left, 0, img.get_width(), img.get_height()])
+        left += img.get_width()
+
+    return (atlas, rects)
+
+def save(atlas, file_name):
+    pygame.image.save(atlas, file_name)
+
+
+class AtlasCache(object):
+    """ loaded session atlases, least recently used ones are evicted above the capacity """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.atlases = OrderedDict() # sess_id -> (atlas, subsurfaces)
+
+    def put(self, sess_id, atlas, rects):
+        """ adds atlas, returns list of subsurfaces for the given rects """
+        images = [atlas.subsurface(pygame.Rect(rect)) for rect in rects]
+        self.atlases.pop(sess_id, None)
+        self.atlases[sess_id] = (atlas, images)
+        while len(self.atlases) > self.capacity:
+            evicted_id, _ = self.atlases.popitem(last=False)
+            logger.debug("evicting atlas of session %d", evicted_id)
+        return images
+
+    def get(self, sess_id, file_name, rects):
+        """ returns list of subsurfaces, loads the atlas from file if it's not in cache """
+        if sess_id in self.atlases:
+            entry = self.atlases.pop(sess_id)
+            self.atlases[sess_id] = entry # most recently used
+            return entry[1]
+
+        atlas = pygame.image.load(file_name).convert()
+        return self.put(sess_id, atlas, rects)
+
+    def retain(self, sess_ids):
+        """ evicts atlases of sessions other than the given ones """
+        for sess_id in self.atlases.keys():
+            if sess_id not in sess_ids:
+                del self.atlases[sess_id]
@@ -1,34 +1,120 @@
 # encoding: utf-8
 from local_modules.piggyphoto import piggyphoto
-from StringIO import StringIO
+from cStringIO import StringIO
 from threading import Thread, Lock, Condition
 import thread # for interrupt_main
-from Queue import Queue
+import time
 
 import pygame
+from photobooth.view import LivePreview
 
 import logging
 logger = logging.getLogger('photobooth.%s' % __name__)
 
 
-class GPhotoCamera(object):
+def fit_overlay(overlay, frame_size):
+    """ (overlay, rect) centered over the frame, overlay too big for the frame is downscaled keeping its aspect ratio """
+    width, height = overlay.get_size()
+    scale = min(1., float(frame_size[0]) / width, float(frame_size[1]) / height)
+    if scale < 1.:
+        overlay = pygame.transform.smoothscale(overlay, (int(width * scale), int(height * scale)))
+    return (overlay, overlay.get_rect(center=(frame_size[0] / 2, frame_size[1] / 2)))
+
+
+class FrameMailbox(object):
+    """
+    Single-slot, latest-wins frame exchange between live view stages.
+    Posting a frame overwrites the unread one (counted as dropped), so a stalled consumer
+    never causes frames to pile up and the consumer always gets the newest frame.
+    The last frame taken by the consumer is remembered, so the producer can tell which buffers are in use.
+    """
     def __init__(self):
+        self.cond = Condition()
+        self.frame = None
+        self.taken = None
+        self.closed = False
+        self.posted = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        with self.cond:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.posted += 1
+            self.cond.notify()
+
+    def get(self):
+        """ blocks until new frame is available, returns None if mailbox has been closed """
+        with self.cond:
+            while self.frame is None and not self.closed:
+                self.cond.wait()
+            return self.take()
+
+    def get_nowait(self):
+        """ returns new frame or None if there was nothing posted since the last read """
+        with self.cond:
+            return self.take()
+
+    def take(self):
+        """ with self.cond held """
+        frame, self.frame = self.frame, None
+        if frame is not None:
+            self.taken = frame
+        return frame
+
+    def frames_in_use(self):
+        """ (last taken, unread) frames - atomically with respect to the consumer """
+        with self.cond:
+            return (self.taken, self.frame)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class GPhotoCamera(object):
+    # decode-target surfaces: one being decoded into, one displayed, one spare for the renderer
+    PREVIEW_BUFFERS = 3
+    # config widgets controlling the mirror (Nikon/generic, Canon EOS)
+    VIEWFINDER_WIDGETS = ["viewfinder", "eosviewfinder"]
+
+    def __init__(self, config):
         """ Camera initialisation """
+        self.conf = config
         try:
             self.cam = piggyphoto.Camera()
         except piggyphoto.libgphoto2error, exc:
             raise ValueError("GPhotoCamera could not be initialised: %s" % exc.message)
         print "CAMERA: %s " % self.cam.abilities
 
+        # camera config tree is read only once (it's slow) and kept for the whole camera lifetime
+        self.config_tree = None
+
         # sync camera time with host
-        cc = self.cam.config
-        syncdate = cc.get_child_by_name("syncdatetime")
-        syncdate.value = 1
-        self.cam.config = cc
+        self.set_config_value(["syncdatetime"], 1)
 
-        self.preview_jpegs = Queue(maxsize=0)
-        self.preview_surfaces = Queue(maxsize=0)
+        self.preview_jpegs = FrameMailbox()
+        self.preview_surfaces = FrameMailbox()
         self.curr_preview = pygame.Surface((1, 1)) # will be overriden by real image
+        self.preview_generation = 0 # incremented with every new frame served by capture_preview
+
+        # live view ring of preallocated surfaces (allocated lazily on the first frame)
+        self.preview_buffers = []
+        self.preview_buffer_idx = 0
+        self.preview_flip_scratch = None # mirrored frame in the decoder's pixel format
+
+        # live view JPEG decoder, mirroring and overlay blending are done once per frame in the decoding thread
+        self.preview_flipped = self.conf['view']['flip_preview']
+        self.preview_overlay = None
+        self.preview_overlay_fitted = None # (overlay, frame size, fitted overlay and rect), decoding thread only
+        if self.conf['camera']['preview_decoder'] == "draft":
+            from PIL import Image
+            self.pil_image = Image
+            self.decode_preview = self.decode_preview_draft
+        else:
+            self.decode_preview = self.decode_preview_pygame
 
         # thread-safe objects
         self.paused = Condition()
@@ -65,26 +151,135 @@ class GPhotoCamera(object):
                 except piggyphoto.libgphoto2error:
                     logger.error("CAMERA EXCEPTION, EXITING!")
                     thread.interrupt_main()
+                # cStringIO only references the JPEG string, no additional copy is being made
                 picture = StringIO(cfile.get_data())
                 self.preview_jpegs.put(picture)
-                #logger.debug("capture_worker: preview captured!, queue size: %d" % self.preview_jpegs.qsize())
 
     def loadpreview_worker(self):
         """
-        Thread: gets new JPEGs data from queue, loads them into surface and converts
+        Thread: gets the newest JPEG data from the mailbox, decodes it and copies it into the ring of surfaces.
+        Display-format surfaces, mirroring and overlay blending reuse preallocated memory, the allocations
+        left per frame are the ones neither gPhoto2 nor the decoders let us avoid: the JPEG string
+        (and its cStringIO wrapper) and the decoder output - pygame.image.load surface, or PIL image,
+        its thumbnail and pixel string for the draft decoder.
         """
-        # drop frames
         while self.threads_running:
-            while self.preview_jpegs.qsize() > 1:
-                logger.info("DROPPING FRAME!")
-                self.preview_jpegs.get()
-                self.preview_jpegs.task_done()
-
             file_io = self.preview_jpegs.get()
+            if file_io is None: # closing
+                return
+
             #logger.debug("LOADPREVIEW: loading frame")
-            picture = pygame.image.load(file_io).convert()
-            self.preview_jpegs.task_done()
-            self.curr_preview = picture
+            picture = self.next_preview_buffer(self.decode_preview(file_io))
+            self.preview_surfaces.put(picture)
+
+    @staticmethod
+    def decode_preview_pygame(file_io):
+        """ full-size decode (the view will clip it) """
+        return pygame.image.load(file_io)
+
+    def decode_preview_draft(self, file_io):
+        """
+        Reduced-size decode: libjpeg scales the DCT output by 1/2, 1/4 or 1/8 (the smallest
+        one still covering the LivePreview size). Bigger result is downscaled keeping the aspect ratio,
+        smaller one is left as is (the view will clip/center it)
+        """
+        img = self.pil_image.open(file_io)
+        img.draft('RGB', (LivePreview.WIDTH, LivePreview.HEIGHT))
+        img.thumbnail((LivePreview.WIDTH, LivePreview.HEIGHT), self.pil_image.BILINEAR)
+        return pygame.image.frombuffer(img.tobytes(), img.size, 'RGB')
+
+    def next_preview_buffer(self, decoded):
+        """
+        Copies decoded frame into the next surface from the ring (converting it to the display format
+        on the way) instead of allocating new surface with convert() for every frame
+        """
+        size = decoded.get_size()
+        if not self.preview_buffers or self.preview_buffers[0].get_size() != size:
+            logger.debug("allocating %d preview buffers of size %s", self.PREVIEW_BUFFERS, size)
+            self.preview_buffers = [pygame.Surface(size).convert() for _ in xrange(self.PREVIEW_BUFFERS)]
+
+        # never overwrite the frame being displayed nor the one waiting in the mailbox
+        in_use = self.preview_surfaces.frames_in_use()
+        self.preview_buffer_idx = (self.preview_buffer_idx + 1) % self.PREVIEW_BUFFERS
+        while self.preview_buffers[self.preview_buffer_idx] in in_use:
+            self.preview_buffer_idx = (self.preview_buffer_idx + 1) % self.PREVIEW_BUFFERS
+        surface = self.preview_buffers[self.preview_buffer_idx]
+        surface.blit(self.flip_preview(decoded) if self.preview_flipped else decoded, (0, 0))
+
+        overlay = self.preview_overlay
+        if overlay:
+            surface.blit(*self.get_fitted_overlay(overlay, size))
+        return surface
+
+    def flip_preview(self, decoded):
+        """
+        Mirrors decoded frame into the preallocated scratch surface (transform.flip would allocate new one).
+        PixelArray copies only between the same pixel formats, the blit into the ring converts it afterwards.
+        """
+        scratch = self.preview_flip_scratch
+        if scratch is None or scratch.get_size() != decoded.get_size() or \
+                scratch.get_bitsize() != decoded.get_bitsize() or scratch.get_masks() != decoded.get_masks():
+            scratch = self.preview_flip_scratch = decoded.copy()
+
+        pygame.PixelArray(scratch)[:] = pygame.PixelArray(decoded)[::-1] # arrays (and surface locks) freed right away
+        return scratch
+
+    def get_fitted_overlay(self, overlay, size):
+        """ overlay fitted to the frame, fitted again only when the overlay or the frame size changes """
+        fitted = self.preview_overlay_fitted
+        if fitted is None or fitted[0] is not overlay or fitted[1] != size:
+            fitted = self.preview_overlay_fitted = (overlay, size, fit_overlay(overlay, size))
+        return fitted[2]
+
+    def set_preview_overlay(self, overlay):
+        """ image to be blended into the center of every next live view frame (None to disable) """
+        self.preview_overlay = overlay
+
+    def get_preview_stats(self):
+        """
+        returns live view frame counters: captured, decoded and dropped
+        (overwritten before being decoded or before being displayed)
+        """
+        return {
+            'captured': self.preview_jpegs.posted,
+            'decoded': self.preview_surfaces.posted,
+            'dropped': self.preview_jpegs.dropped + self.preview_surfaces.dropped,
+        }
+
+    def get_config(self):
+        """ cached gPhoto2 config tree of the open camera """
+        if self.config_tree is None:
+            self.config_tree = self.cam.config
+        return self.config_tree
+
+    def set_config_value(self, widget_names, value):
+        """
+        Sets the value of the first widget from the list which is supported by the camera.
+        Returns False if none of the widgets could be set.
+        """
+        config = self.get_config()
+        for name in widget_names:
+            try:
+                widget = config.get_child_by_name(name)
+            except piggyphoto.libgphoto2error:
+                continue
+
+            # libgphoto2 sends only the widgets marked as changed and setting the value the cached tree
+            # already holds (eg. viewfinder=0 from the previous session) does not mark it - toggling does
+            if widget.value == value:
+                widget.value = int(not value)
+            widget.value = value
+            self.cam.config = config
+            return True
+
+        logger.warn("camera does not support any of config widgets: %s", widget_names)
+        return False
+
+    def reopen(self):
+        """ closing and reopening the camera, drops the cached config tree """
+        self.cam.close()
+        self.cam = piggyphoto.Camera()
+        self.config_tree = None
 
     def pause_preview(self):
         self.is_paused = True
@@ -102,14 +297,23 @@ class GPhotoCamera(object):
         logger.debug("stop_preview")
         with self.paused:
             self.is_paused = True
+        logger.debug("live view stats: %s", self.get_preview_stats())
         with self.camera_lock:
-            # gPhoto2: not nice, we have to close and reopen the camera to get the mirror down
-            self.cam.close()
-            self.cam = piggyphoto.Camera()
+            if self.conf['camera']['mirror_down'] == "viewfinder":
+                # get the mirror down by switching off the viewfinder on the open camera
+                if not self.set_config_value(self.VIEWFINDER_WIDGETS, 0):
+                    self.reopen()
+            else:
+                # gPhoto2: not nice, we have to close and reopen the camera to get the mirror down
+                self.reopen()
         logger.debug("stop_preview END")
 
     def capture_preview(self):
-        """ Single LiveView frame """
+        """ Single LiveView frame - the newest decoded one, never blocks """
+        picture = self.preview_surfaces.get_nowait()
+        if picture is not None:
+            self.curr_preview = picture
+            self.preview_generation += 1
         return self.curr_preview
 
     def capture_image(self, file_path):
@@ -129,7 +333,8 @@ class GPhotoCamera(object):
             self.threads_running = False
             self.paused.notify()
         self.thread_capture.join()
-        #self.thread_loadpreview.join()
+        self.preview_jpegs.close()
+        self.thread_loadpreview.join()
 
         with self.camera_lock:
             self.cam.close()
@@ -141,9 +346,13 @@ class DummyCamera(object):
     """
     CAPTURE_COUNT = 4
 
-    def __init__(self):
+    def __init__(self, config):
         print "CAMERA: DummyCamera serving only static JPEGs"
+        self.conf = config
         self.curr_capture = 0
+        self.preview_flipped = self.conf['view']['flip_preview']
+        self.preview_overlay = None
+        self.preview_generation = 0
 
     def start_preview(self):
         """ initiate grabbing previews """
@@ -157,12 +366,20 @@ class DummyCamera(object):
         """ stop grabbing previews, but do not deinit """
         pass
 
-    @staticmethod
-    def capture_preview():
+    def capture_preview(self):
         """ return single preview frame """
         picture = pygame.image.load("dev/dummy-preview.jpg").convert()
+        if self.preview_flipped:
+            picture = pygame.transform.flip(picture, True, False)
+        if self.preview_overlay:
+            picture.blit(*fit_overlay(self.preview_overlay, picture.get_size()))
+        self.preview_generation += 1
         return picture
 
+    def set_preview_overlay(self, overlay):
+        """ image to be blended into the center of every next live view frame (None to disable) """
+        self.preview_overlay = overlay
+
     def capture_image(self, file_path):
         """
         Captures the image, for better testing this is a full-size img.
@@ -190,7 +407,90 @@ class DummyCamera(object):
         # import shutil
         # shutil.copyfile("dev/dummy-capture.jpg", file_path)
 
+    @staticmethod
+    def get_preview_stats():
+        """ no live view pipeline - no counters """
+        return {'captured': 0, 'decoded': 0, 'dropped': 0}
+
     def close(self):
         """ deinit camera """
         pass
 
+
+
+class SyntheticCamera(DummyCamera):
+    """
+    Benchmarking camera: live view frames are served from memory at configured rate
+    (camera.synthetic_fps), captures are pre-encoded JPEG written after camera.synthetic_capture_ms.
+    Frames are mirrored and blended with the overlay into the ring of buffers like with the real camera.
+    """
+    FRAMES_CNT = 8
+
+    def __init__(self, config):
+        print "CAMERA: SyntheticCamera serving in-memory frames at %d FPS" % config['camera']['synthetic_fps']
+        self.conf = config
+        self.preview_flipped = self.conf['view']['flip_preview']
+        self.preview_overlay = None
+        self.preview_generation = 0
+        self.frame_interval_ms = 1000. / self.conf['camera']['synthetic_fps']
+        self.capture_secs = self.conf['camera']['synthetic_capture_ms'] / 1000.
+        with open("dev/dummy-capture.jpg", "rb") as capture_file:
+            self.capture_data = capture_file.read()
+
+        self.frames = None # rendered when the display is ready (convert needs it)
+        self.buffers = None
+        self.curr_buffer = 0
+        self.curr_preview = None
+        self.next_frame_ticks = 0
+        self.dropped = 0
+
+    def prepare_frames(self):
+        """ distinct frames (moving bar over the dummy preview), mirrored once """
+        base = pygame.image.load("dev/dummy-preview.jpg")
+        base = pygame.transform.scale(base, (LivePreview.WIDTH, LivePreview.HEIGHT)).convert()
+        if self.preview_flipped:
+            base = pygame.transform.flip(base, True, False)
+
+        bar_width = LivePreview.WIDTH / self.FRAMES_CNT
+        self.frames = []
+        for num in xrange(self.FRAMES_CNT):
+            frame = base.copy()
+            frame.fill((255, 255, 255), (num * bar_width, 0, bar_width, 8))
+            self.frames.append(frame)
+
+        self.buffers = [base.copy() for _ in xrange(GPhotoCamera.PREVIEW_BUFFERS)]
+
+    def start_preview(self):
+        """ frames not taken while the previews were paused are not counted as dropped """
+        self.curr_preview = None
+
+    def capture_preview(self):
+        """ returns the current frame, new one every frame interval """
+        if self.frames is None:
+            self.prepare_frames()
+
+        now = pygame.time.get_ticks()
+        if self.curr_preview is None or now >= self.next_frame_ticks:
+            if self.curr_preview is not None:
+                missed = int((now - self.next_frame_ticks) / self.frame_interval_ms)
+                self.dropped += missed
+            self.next_frame_ticks = now + self.frame_interval_ms
+
+            self.curr_buffer = (self.curr_buffer + 1) % len(self.buffers)
+            buf = self.buffers[self.curr_buffer]
+            buf.blit(self.frames[self.preview_generation % self.FRAMES_CNT], (0, 0))
+            if self.preview_overlay:
+                buf.blit(*fit_overlay(self.preview_overlay, buf.get_size()))
+            self.curr_preview = buf
+            self.preview_generation += 1
+
+        return self.curr_preview
+
+    def capture_image(self, file_path):
+        """ simulated shutter/transfer time, then the same full-size JPEG every time """
+        time.sleep(self.capture_secs)
+        with open(file_path, "wb") as image_file:
+            image_file.write(self.capture_data)
+
+    def get_preview_stats(self):
+        return {'captured': self.preview_generation, 'decoded': self.preview_generation, 'dropped': self.dropped}
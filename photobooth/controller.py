@@ -3,16 +3,20 @@ import pygame
 import photobooth.model as model
 import photobooth.view as view
 import photobooth.upload as upload
+from photobooth.derivatives import DerivativeService, MEDIUM_SIZE, PREV_SIZE
 import platform_devs
 from common.printer import PrinterProxy
 from threading import Thread
 from Queue import Queue
+from multiprocessing.pool import ThreadPool
 import multiprocessing
 
 
 import logging
 logger = logging.getLogger('photobooth.%s' % __name__)
 
+PLACEHOLDER_COLOR = (64, 64, 64) # images which failed post-processing
+
 class PhotoBoothController(object):
     """ controlling the logic flow around the whole application """
 
@@ -20,11 +24,15 @@ class PhotoBoothController(object):
     BUTTON_KEY= pygame.K_SPACE,
 
     BUTTONPUSHEVENT = pygame.USEREVENT + 2
+    FRAMEDUEEVENT = pygame.USEREVENT + 3
 
     def __init__(self, config, camera):
         self.conf = config
         self.camera = camera
         self.printer = PrinterProxy(self.conf)
+        # decoding and scaling of the captured images is done in other processes to bypass GIL
+        self.derivatives = DerivativeService(self.conf['control']['derivative_processes'],
+                                             self.conf['control']['postprocess_workers'])
 
         # platform and pygame
         logger.info("PLATFORM: %s" % platform_devs.running_platform)
@@ -52,6 +60,9 @@ class PhotoBoothController(object):
         self.thread_capture = Thread(target=self.capture_image_worker)
         self.thread_capture.setDaemon(True)
 
+        # post-processing of the captured images (decode, scale, save) overlaps with the next capture
+        self.postprocess_pool = ThreadPool(self.conf['control']['postprocess_workers'])
+
         # upload background process (creating GIF is cpu-intensive, make it happen in other process to bypass GIL)
         self.upload_pipe = None
         if self.conf['upload']['enabled']:
@@ -60,11 +71,17 @@ class PhotoBoothController(object):
             self.process_upload = multiprocessing.Process(target=upload.run, args=(self.conf, pipe))
             self.process_upload.daemon = True
 
+            # sending to the uploader may block (full pipe), never do it on the render thread
+            self.upload_sends = Queue(maxsize=0)
+            self.thread_upload_send = Thread(target=self.upload_send_worker)
+            self.thread_upload_send.setDaemon(True)
+            self.thread_upload_send.start()
+
             # try to reupload not yet uploaded sessions
             if self.conf['upload']['retrying']:
                 for sess in to_upload_sessions:
-                    self.upload_pipe.send((sess.id, sess.get_medium_img_paths(),\
-                        sess.get_full_img_paths(), sess.random_tags))
+                    self.upload_sends.put((sess.id, sess.get_medium_img_paths(),\
+                        sess.get_full_img_paths(), sess.random_tags, None))
 
 
         self.next_fps_update_ticks = 0
@@ -86,7 +103,7 @@ class PhotoBoothController(object):
         #self.lights.set_brightness(self.conf["devices"]["lights_full"])
 
         while self.is_running:
-            self.clock.tick(self.view.fps)
+            self.wait_for_next_frame()
             button_pressed = self.process_events()
             self.button.update_state()
 
@@ -101,6 +118,27 @@ class PhotoBoothController(object):
 
         self.quit()
 
+    def wait_for_next_frame(self):
+        """
+        Live view is rendered at constant FPS, on the idle screen we're sleeping until the next
+        animation frame is due (or an event arrives, or max_frame_delay_ms passes)
+        """
+        if not self.view.idle:
+            self.clock.tick(self.view.fps)
+            return
+
+        delay = self.view.next_frame_delay()
+        if delay is None or delay > self.conf['display']['max_frame_delay_ms']:
+            delay = self.conf['display']['max_frame_delay_ms']
+
+        if delay > 0:
+            pygame.time.set_timer(self.FRAMEDUEEVENT, delay)
+            event = pygame.event.wait()
+            pygame.time.set_timer(self.FRAMEDUEEVENT, 0)
+            if event.type != self.FRAMEDUEEVENT:
+                pygame.event.post(event) # to be handled by process_events
+        self.clock.tick()
+
     def quit(self):
         self.is_running = False
         if self.model:
@@ -109,6 +147,12 @@ class PhotoBoothController(object):
         if self.upload_pipe:
             self.upload_pipe.close()
             self.upload_pipe = None
+        if self.postprocess_pool:
+            self.postprocess_pool.terminate()
+            self.postprocess_pool = None
+        if self.derivatives:
+            self.derivatives.close()
+            self.derivatives = None
 
         self.lights.pause()
         pygame.quit()
@@ -144,11 +188,14 @@ class PhotoBoothController(object):
         self.view.lv.start()
 
     def stop_live_view(self, still_img=None):
+        """ the still image replaces the live view, without it the last live view frame is kept """
         self.live_view_running = False
         self.camera.stop_preview()
-        self.view.lv.stop()
         if still_img:
+            self.view.lv.stop()
             self.view.lv.set_image(still_img)
+        else:
+            self.view.lv.freeze()
 
     def schedule_stop_live_view(self, still_img=None):
         """ does not stop camera previews """
@@ -191,24 +238,42 @@ class PhotoBoothController(object):
             else:
                 self.lights.pause()
 
-            # (4) load captured images and scale them
-            logger.debug("capture_image_worker: reading and scalling images")
-            img = pygame.image.load(image_name).convert()
-            img_lv = pygame.transform.scale(img, (view.LivePreview.WIDTH, view.LivePreview.HEIGHT))
-            img_prev = pygame.transform.scale(img_lv, (view.SmallPhotoPreview.WIDTH, view.SmallPhotoPreview.HEIGHT))
-
-            # (5) view: set the preview image
-            self.view.main_previews[image_number].set_image(img_prev)
-            self.view.main_previews[image_number].end_overlay()
-
-            # (6) save the scalled images
-            pygame.image.save(img_prev, prev_name)
-            pygame.image.save(img_lv, medium_name)
+            # (4) schedule post-processing, the camera is free for the next shot in the meantime
+            result = self.postprocess_pool.apply_async(self.process_captured_image,
+                                                       (image_number, image_name, medium_name, prev_name))
 
-            # (7) finish the task and send the results
+            # (5) finish the task and send the (future) results
             logger.debug("capture_image_worker: DONE")
             self.capture_names.task_done()
-            self.model.set_current_session_imgs(image_number, (img, img_lv, img_prev))
+            self.model.set_current_session_imgs(image_number, result)
+
+    def process_captured_image(self, image_number, image_name, medium_name, prev_name):
+        """ Pool worker: scaled images are rendered and saved by the derivatives process pool """
+        image_names = (image_name, medium_name, prev_name)
+        preview = self.view.main_previews[image_number]
+
+        # (1) instant preview from the thumbnail embedded by the camera
+        has_instant_preview = False
+        if self.conf['control']['embedded_preview']:
+            img_thumb = self.derivatives.render_embedded_preview(image_names)
+            if img_thumb:
+                preview.set_image(img_thumb)
+                preview.end_overlay()
+                has_instant_preview = True
+
+        # (2) render scaled images (the full-size one is not being kept in memory)
+        logger.debug("process_captured_image: rendering scaled images %d", image_number)
+        img_lv, img_prev = self.derivatives.render(image_names)
+
+        # (3) view: set the preview image (or replace the instant one with the full-quality one)
+        if has_instant_preview:
+            preview.replace_image(img_prev)
+        else:
+            preview.set_image(img_prev)
+            preview.end_overlay()
+
+        logger.debug("process_captured_image: DONE %d", image_number)
+        return (None, img_lv, img_prev)
 
     def capture_image(self, image_number, file_paths):
         # lights - maximum brightness
@@ -232,6 +297,17 @@ class PhotoBoothController(object):
         img = pygame.image.load(file_path).convert()
         return img
 
+    @staticmethod
+    def create_placeholder_image(size_idx, file_path):
+        """ stand-in (1: medium, 2: prev) for the image which failed post-processing, saved in place of it """
+        img = pygame.Surface(MEDIUM_SIZE if size_idx == 1 else PREV_SIZE)
+        img.fill(PLACEHOLDER_COLOR)
+        try:
+            pygame.image.save(img, file_path)
+        except pygame.error:
+            logger.exception("saving placeholder '%s' failed", file_path)
+        return img
+
     def enqueue_animate_montage(self, img_list):
         self.view.lv.enqueue_animate_montage(img_list, self.conf["control"]["montage_fps"])
 
@@ -239,11 +315,30 @@ class PhotoBoothController(object):
         prev_num = 1
         for img_list in self.model.get_idle_previews_image_lists():
             #logger.debug("preview[%d] = %s <- %s" % (prev_num, self.view.idle_previews[prev_num], img_list))
-            self.view.idle_previews[prev_num].start_animate(img_list, 0) # if fps == 0 -> sync whith display FPS
+            self.view.idle_previews[prev_num].start_animate(img_list, self.conf['display']['idle_anim_fps'])
             prev_num += 1
 
     def notify_finished_session(self, sess):
         """ Start work related with finished session processing - uploading and printing"""
         self.printer.print_session(sess.id, sess.medium_img_list, sess.random_tags)
         if self.conf["upload"]["enabled"]:
-            self.upload_pipe.send((sess.id, sess.get_medium_img_paths(), sess.get_full_img_paths(), sess.random_tags))
+            # GIF is created from the images we already have in memory, no need to decode the JPEGs again.
+            # The surfaces are still being displayed - the sending thread gets copies to serialize
+            self.upload_sends.put((sess.id, sess.get_medium_img_paths(), sess.get_full_img_paths(), sess.random_tags,
+                                   [img.copy() for img in sess.medium_img_list]))
+
+    def upload_send_worker(self):
+        """ serializes the medium surfaces (raw RGB) and sends the session to the upload process """
+        while True:
+            (sess_id, medium_paths, full_paths, random_tags, medium_imgs) = self.upload_sends.get()
+            medium_frames = None
+            if medium_imgs:
+                medium_frames = (medium_imgs[0].get_size(), [pygame.image.tostring(img, "RGB") for img in medium_imgs])
+
+            upload_pipe = self.upload_pipe
+            if upload_pipe is None: # quitting
+                return
+            try:
+                upload_pipe.send((sess_id, medium_paths, full_paths, random_tags, medium_frames))
+            except (IOError, EOFError):
+                logger.exception("sending session %d to the uploader failed", sess_id)
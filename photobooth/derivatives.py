@@ -0,0 +1,195 @@
+# encoding: utf-8
+"""
+Rendering 'medium' and 'prev' images from the full-size capture.
+
+Decoding and scaling 18-24 MP JPEGs is CPU-heavy, doing it in the main process would hold the GIL
+and make the UI stutter. The work is done in a separate process pool and the decoded RGB pixels
+are handed back through shared memory, so the view only needs to wrap them into surfaces.
+"""
+import ctypes
+import struct
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from Queue import Queue
+from cStringIO import StringIO
+
+from PIL import Image
+import pygame
+from photobooth.view import LivePreview, SmallPhotoPreview
+
+import logging
+logger = logging.getLogger('photobooth.%s' % __name__)
+
+MEDIUM_SIZE = (LivePreview.WIDTH, LivePreview.HEIGHT)
+PREV_SIZE = (SmallPhotoPreview.WIDTH, SmallPhotoPreview.HEIGHT)
+MEDIUM_BYTES = MEDIUM_SIZE[0] * MEDIUM_SIZE[1] * 3
+PREV_BYTES = PREV_SIZE[0] * PREV_SIZE[1] * 3
+JPEG_QUALITY = 90
+
+# shared memory slots, inherited by the pool workers
+worker_slots = None
+
+def init_worker(slots):
+    """ pool worker initialisation """
+    global worker_slots
+    worker_slots = slots
+
+def render_derivatives(slot_idx, full_name, medium_name, prev_name):
+    """
+    Pool worker: decodes the full-size image, saves scaled images and
+    writes their RGB pixels into the shared memory slot
+    """
+    img_medium, img_prev = scale_draft(full_name)
+
+    img_prev.save(prev_name, quality=JPEG_QUALITY)
+    img_medium.save(medium_name, quality=JPEG_QUALITY)
+
+    slot = worker_slots[slot_idx]
+    slot[0:MEDIUM_BYTES] = img_medium.tobytes()
+    slot[MEDIUM_BYTES:MEDIUM_BYTES + PREV_BYTES] = img_prev.tobytes()
+
+def scale_draft(full_name):
+    """
+    Shrink-on-load: libjpeg decodes the image already scaled down by 1/2, 1/4 or 1/8
+    (the smallest still covering MEDIUM_SIZE), so the full-size bitmap is never in memory.
+    Returns (medium, prev) PIL images.
+    """
+    img = Image.open(full_name)
+    img.draft('RGB', MEDIUM_SIZE)
+    img_medium = img.convert('RGB').resize(MEDIUM_SIZE, Image.ANTIALIAS)
+    img_prev = img_medium.resize(PREV_SIZE, Image.ANTIALIAS)
+    return (img_medium, img_prev)
+
+def extract_embedded_preview(full_name):
+    """
+    Returns JPEG data of the thumbnail embedded by the camera in EXIF (IFD1), or None.
+    Only the APP1 segment at the beginning of the file is being read.
+    """
+    with open(full_name, 'rb') as img_file:
+        if img_file.read(2) != '\xff\xd8':
+            return None
+        # find APP1 (Exif) segment, it should be one of the first ones
+        while True:
+            header = img_file.read(4)
+            if len(header) < 4:
+                return None
+            marker, length = struct.unpack('>2sH', header)
+            if marker == '\xff\xe1':
+                app1 = img_file.read(length - 2)
+                break
+            if marker[0] != '\xff' or marker in ('\xff\xda', '\xff\xd9'): # no more metadata
+                return None
+            img_file.seek(length - 2, 1)
+
+    if not app1.startswith('Exif\x00\x00'):
+        return None
+    tiff = app1[6:]
+    endian = {'II': '<', 'MM': '>'}.get(tiff[:2])
+    if not endian:
+        return None
+
+    def read(fmt, offset):
+        return struct.unpack_from(endian + fmt, tiff, offset)[0]
+
+    try:
+        # skip IFD0 to get to IFD1 (thumbnail)
+        ifd0 = read('I', 4)
+        ifd1 = read('I', ifd0 + 2 + 12 * read('H', ifd0))
+        if ifd1 == 0:
+            return None
+
+        thumb_offset = thumb_length = None
+        for entry_no in xrange(read('H', ifd1)):
+            entry = ifd1 + 2 + 12 * entry_no
+            tag = read('H', entry)
+            if tag == 0x0201: # JPEGInterchangeFormat
+                thumb_offset = read('I', entry + 8)
+            elif tag == 0x0202: # JPEGInterchangeFormatLength
+                thumb_length = read('I', entry + 8)
+    except struct.error:
+        logger.warn("malformed EXIF data in: %s", full_name)
+        return None
+
+    if not thumb_offset or not thumb_length:
+        return None
+    return tiff[thumb_offset:thumb_offset + thumb_length]
+
+def scale_embedded_preview(thumb_data):
+    """
+    Embedded thumbnail (usually 160x120 with black bars) cropped to the PREV_SIZE aspect ratio
+    and scaled to PREV_SIZE, as PIL image
+    """
+    img = Image.open(StringIO(thumb_data)).convert('RGB')
+    width, height = img.size
+    crop_height = min(height, width * PREV_SIZE[1] // PREV_SIZE[0])
+    top = (height - crop_height) // 2
+    return img.crop((0, top, width, top + crop_height)).resize(PREV_SIZE, Image.ANTIALIAS)
+
+def scale_full(full_name):
+    """ Reference: full-size decode and scaling with pygame. Returns (medium, prev) surfaces. """
+    img = pygame.image.load(full_name)
+    img_medium = pygame.transform.scale(img, MEDIUM_SIZE)
+    img_prev = pygame.transform.scale(img_medium, PREV_SIZE)
+    return (img_medium, img_prev)
+
+
+class DerivativeService(object):
+    """
+    Process pool producing 'medium' and 'prev' images for the file names
+    returned by PhotoBoothModel.get_image_names_all
+    """
+    def __init__(self, processes, slots_cnt):
+        # one shared memory slot per image being rendered at once
+        self.slots = [RawArray(ctypes.c_char, MEDIUM_BYTES + PREV_BYTES) for _ in xrange(slots_cnt)]
+        self.free_slots = Queue()
+        for slot_idx in xrange(slots_cnt):
+            self.free_slots.put(slot_idx)
+
+        self.pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(self.slots,))
+
+    def render(self, image_names):
+        """
+        Blocks until the derivatives are saved, returns (medium, prev) surfaces
+        converted to the display format.
+        """
+        full_name, medium_name, prev_name = image_names
+        slot_idx = self.free_slots.get()
+        try:
+            self.pool.apply(render_derivatives, (slot_idx, full_name, medium_name, prev_name))
+
+            slot_addr = ctypes.addressof(self.slots[slot_idx])
+            img_medium = self.wrap_rgb(slot_addr, MEDIUM_SIZE)
+            img_prev = self.wrap_rgb(slot_addr + MEDIUM_BYTES, PREV_SIZE)
+        finally:
+            self.free_slots.put(slot_idx)
+
+        return (img_medium, img_prev)
+
+    @staticmethod
+    def wrap_rgb(address, size):
+        """ RGB pixels from shared memory into a display-format surface """
+        pixels = ctypes.string_at(address, size[0] * size[1] * 3)
+        return pygame.image.frombuffer(pixels, size, "RGB").convert()
+
+    @staticmethod
+    def render_embedded_preview(image_names):
+        """
+        Instant preview: saves the 'prev' image made from the thumbnail embedded in the capture
+        (to be overwritten by render()), returns it as display-format surface or None if there is no thumbnail
+        """
+        full_name, _, prev_name = image_names
+        thumb_data = extract_embedded_preview(full_name)
+        if not thumb_data:
+            return None
+
+        try:
+            img_prev = scale_embedded_preview(thumb_data)
+            img_prev.save(prev_name, quality=JPEG_QUALITY)
+        except (IOError, SyntaxError):
+            # truncated/corrupt thumbnail: fall back to the full-quality preview
+            logger.warn("broken embedded thumbnail in: %s", full_name, exc_info=True)
+            return None
+        return pygame.image.frombuffer(img_prev.tobytes(), PREV_SIZE, "RGB").convert()
+
+    def close(self):
+        self.pool.terminate()
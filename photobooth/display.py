@@ -0,0 +1,154 @@
+# encoding: utf-8
+"""
+Display backends used by the PygView.
+
+software - classic pygame display surface, every blit and the screen update go through the CPU
+gl       - OpenGL: every blitted sprite image is uploaded once as a texture and the whole screen
+           is composited by the GPU (textured quads), so the CPU does no copying of the pixels on screen.
+           Needs PyOpenGL and an OpenGL context (on the Pi: the GL driver enabled), falls back to
+           the software backend if any of them is missing (eg. headless with SDL dummy video driver).
+
+Both backends provide:
+    canvas  - object with blit(surface, dest) method, the sprites are drawing onto it
+    update(rects) - present the changed parts of the screen
+    flip()  - present the whole screen
+"""
+from collections import OrderedDict
+
+import pygame
+
+import logging
+logger = logging.getLogger('photobooth.%s' % __name__)
+
+try:
+    from OpenGL import GL
+    # raised by drivers lacking the needed entry points or without a usable context
+    from OpenGL.error import NullFunctionError, NoContext
+except ImportError:
+    GL = None
+
+
+def create(conf):
+    """ display of the configured backend, falls back to the software one """
+    size = (conf['display']['screen_width'], conf['display']['screen_height'])
+    fullscreen = conf['display']['fullscreen']
+    backend = conf['display']['backend']
+
+    if backend == 'gl':
+        if GL is None:
+            logger.warn("PyOpenGL not available, falling back to the software display")
+        else:
+            try:
+                return GLDisplay(size, fullscreen)
+            except (pygame.error, GL.GLError, NullFunctionError, NoContext), e:
+                logger.warn("could not initialize OpenGL display (%r), falling back to the software display", e)
+    elif backend != 'software':
+        logger.warn("unknown display backend: %s, using the software one", backend)
+
+    return SoftwareDisplay(size, fullscreen)
+
+
+class SoftwareDisplay(object):
+    """ pygame display surface """
+    name = 'software'
+
+    def __init__(self, size, fullscreen):
+        flags = pygame.DOUBLEBUF | [0, pygame.FULLSCREEN][fullscreen]
+        # dummy video driver (headless runs) defaults to 8-bit palette, we need per-pixel alpha
+        depth = 32 if pygame.display.get_driver() == 'dummy' else 0
+        self.canvas = pygame.display.set_mode(size, flags, depth)
+
+    def update(self, rects):
+        pygame.display.update(rects)
+
+    def flip(self):
+        pygame.display.flip()
+
+
+class TextureCanvas(object):
+    """
+    Records blits as textured layers (one texture per destination rect).
+    The texture is re-uploaded only when something is blitted there again (dirty sprite),
+    blitting a full screen image (background) removes all of the other layers.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.layers = OrderedDict() # (x, y, w, h) -> [texture id, texture size]
+
+    def blit(self, surface, dest):
+        rect = pygame.Rect(dest[0], dest[1], surface.get_width(), surface.get_height())
+        if rect.topleft == (0, 0) and rect.size == self.size:
+            self.clear()
+
+        key = tuple(rect)
+        layer = self.layers.get(key)
+        if layer is None:
+            layer = [GL.glGenTextures(1), None]
+            self.layers[key] = layer
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, layer[0])
+        data = pygame.image.tostring(surface, "RGB")
+        if layer[1] != rect.size:
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, rect.width, rect.height, 0,
+                            GL.GL_RGB, GL.GL_UNSIGNED_BYTE, data)
+            layer[1] = rect.size
+        else:
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, rect.width, rect.height,
+                               GL.GL_RGB, GL.GL_UNSIGNED_BYTE, data)
+        return rect
+
+    def clear(self):
+        if self.layers:
+            GL.glDeleteTextures([layer[0] for layer in self.layers.values()])
+            self.layers.clear()
+
+    def composite(self):
+        """ draws all of the layers in the blitting order """
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT)
+        for (x, y, w, h), layer in self.layers.iteritems():
+            GL.glBindTexture(GL.GL_TEXTURE_2D, layer[0])
+            GL.glBegin(GL.GL_QUADS)
+            GL.glTexCoord2f(0, 0)
+            GL.glVertex2f(x, y)
+            GL.glTexCoord2f(1, 0)
+            GL.glVertex2f(x + w, y)
+            GL.glTexCoord2f(1, 1)
+            GL.glVertex2f(x + w, y + h)
+            GL.glTexCoord2f(0, 1)
+            GL.glVertex2f(x, y + h)
+            GL.glEnd()
+
+
+class GLDisplay(object):
+    """ composites the sprite textures on the GPU """
+    name = 'gl'
+
+    def __init__(self, size, fullscreen):
+        flags = pygame.OPENGL | pygame.DOUBLEBUF | [0, pygame.FULLSCREEN][fullscreen]
+        pygame.display.set_mode(size, flags)
+
+        GL.glViewport(0, 0, size[0], size[1])
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glLoadIdentity()
+        GL.glOrtho(0, size[0], size[1], 0, -1, 1) # pixel coordinates, (0, 0) in top left corner
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glLoadIdentity()
+        GL.glDisable(GL.GL_DEPTH_TEST)
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        GL.glClearColor(0, 0, 0, 1)
+
+        self.canvas = TextureCanvas(size)
+
+    def update(self, rects):
+        # back buffer contents are undefined after swapping - always composite the whole screen
+        self.flip()
+
+    def flip(self):
+        self.canvas.composite()
+        pygame.display.flip()
@@ -0,0 +1,42 @@
+# encoding: utf-8
+"""
+Process-wide font registry and cache of rendered text lines.
+
+SysFont does system font lookup on every call and rendering antialiased text is not cheap,
+while the booth displays the same few lines (countdown digits, messages) over and over again.
+"""
+from collections import OrderedDict
+
+import pygame
+
+TEXT_CACHE_SIZE = 64
+
+fonts = dict()
+rendered_texts = OrderedDict()
+
+def get_font(size):
+    """ default font of the given size, created only once """
+    font = fonts.get(size)
+    if font is None:
+        font = pygame.font.SysFont(pygame.font.get_default_font(), size)
+        fonts[size] = font
+    return font
+
+def render(text, size, color):
+    """
+    Rendered (antialiased) text line from the LRU cache.
+    Note: the returned surface is shared, do not draw onto it.
+    """
+    key = (text, size, tuple(color))
+    surface = rendered_texts.pop(key, None)
+    if surface is None:
+        surface = get_font(size).render(text, True, color)
+        if len(rendered_texts) >= TEXT_CACHE_SIZE:
+            rendered_texts.popitem(last=False)
+    rendered_texts[key] = surface # most recently used
+    return surface
+
+def prerender(lines, size, color):
+    """ warming up the cache, eg. with the countdown digits """
+    for line in lines:
+        render(line, size, color)
@@ -0,0 +1,142 @@
+# encoding: utf-8
+"""
+Animated GIF encoder for the session montages.
+
+All of the frames share one global palette (median cut over the downscaled frames, done by PIL),
+frames are mapped onto it and LZW-compressed by the PIL's C encoder, the GIF stream is assembled
+in memory and written at once. No external processes, no re-decoding of the JPEGs if the frames
+are passed from memory.
+
+Photos from one session share most of the background: every next frame holds only the bounding box
+of the changed pixels, unchanged pixels inside it are transparent and the previous frame is left
+in place (disposal 1), which makes the GIF much smaller to upload.
+"""
+import io
+import struct
+
+from PIL import Image, ImageChops
+
+PALETTE_SAMPLE_SCALE = 2 # frames are downscaled by this factor before palette computation
+LOOP_FOREVER = 0
+TRANSPARENT_INDEX = 255 # the last palette entry is reserved for the unchanged pixels
+DELTA_THRESHOLD = 12 # max difference of the color channel for the pixel to be considered unchanged
+DISPOSE_LEAVE = 1
+
+def frames_from_raw(size, frames_data):
+    """ PIL images from raw RGB buffers (eg. pygame.image.tostring(surface, "RGB")) """
+    return [Image.frombuffer("RGB", size, data, "raw", "RGB", 0, 1) for data in frames_data]
+
+def frames_from_files(file_names):
+    return [Image.open(name).convert("RGB") for name in file_names]
+
+def global_palette(frames, colors=256):
+    """ palette image computed from all of the frames """
+    width, height = frames[0].size
+    sample_size = (width / PALETTE_SAMPLE_SCALE, height / PALETTE_SAMPLE_SCALE)
+    sample = Image.new("RGB", (sample_size[0], sample_size[1] * len(frames)))
+    for num, frame in enumerate(frames):
+        sample.paste(frame.resize(sample_size, Image.NEAREST), (0, num * sample_size[1]))
+    palette_img = sample.quantize(colors)
+
+    # unused entries repeat the first color, so the frames are never mapped onto them
+    palette = palette_img.getpalette()[:3 * colors]
+    palette += palette[:3] * (256 - colors)
+    palette_img.putpalette(palette)
+    return palette_img
+
+def changed_mask(frame, reference, threshold):
+    """ 'L' image: 255 where any channel differs more than the threshold """
+    red, green, blue = ImageChops.difference(frame, reference).split()
+    diff = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+    return diff.point([0] * (threshold + 1) + [255] * (255 - threshold))
+
+def lzw_data(image):
+    """
+    LZW-compressed pixels of the palette image (min code size byte + data sub-blocks + terminator)
+    and image descriptor flags to keep (interlacing). PIL writes them as a part of the single frame GIF,
+    the block is cut out of it.
+    """
+    buf = io.BytesIO()
+    image.save(buf, "GIF", optimize=False, interlace=False)
+    data = buf.getvalue()
+
+    pos = 13 # header + logical screen descriptor
+    flags = ord(data[10])
+    if flags & 0x80:
+        pos += 3 << ((flags & 0x07) + 1)
+
+    while data[pos] == "!": # extensions
+        pos += 2
+        while ord(data[pos]):
+            pos += ord(data[pos]) + 1
+        pos += 1
+
+    assert data[pos] == ",", "GIF image descriptor expected"
+    flags = ord(data[pos + 9])
+    keep_flags = flags & 0x40
+    pos += 10
+    if flags & 0x80:
+        pos += 3 << ((flags & 0x07) + 1)
+
+    start = pos
+    pos += 1 # LZW min code size
+    while ord(data[pos]):
+        pos += ord(data[pos]) + 1
+    return (data[start:pos + 1], keep_flags)
+
+def palette_bytes(palette_img):
+    """ 256-entry color table """
+    palette = palette_img.getpalette()[:768]
+    palette += [0] * (768 - len(palette))
+    return struct.pack("768B", *palette)
+
+def frame_blocks(image, position, delay_ms, transparent_index=None):
+    """ graphic control extension + image descriptor + LZW data of the single frame """
+    packed = DISPOSE_LEAVE << 2
+    if transparent_index is not None:
+        packed |= 1
+    else:
+        transparent_index = 0
+
+    data, flags = lzw_data(image)
+    # delay is in 1/100 s
+    return ("!\xf9" + struct.pack("<BBHBB", 4, packed, delay_ms / 10, transparent_index, 0) +
+            "," + struct.pack("<HHHHB", position[0], position[1], image.size[0], image.size[1], flags) +
+            data)
+
+def encode(frames, delay_ms, loop=LOOP_FOREVER, threshold=DELTA_THRESHOLD):
+    """ animated GIF as a string, all frames have to be of the same size """
+    width, height = frames[0].size
+    palette_img = global_palette(frames, TRANSPARENT_INDEX)
+
+    out = ["GIF89a",
+           struct.pack("<HHBBB", width, height, 0xf7, 0, 0), # global color table of 256 colors
+           palette_bytes(palette_img),
+           "!\xff\x0bNETSCAPE2.0" + struct.pack("<BBHB", 3, 1, loop, 0)]
+
+    # first frame as a whole
+    out.append(frame_blocks(frames[0].quantize(palette=palette_img), (0, 0), delay_ms))
+
+    # next frames: changed pixels only, compared with the source pixels currently on screen
+    reference = frames[0].copy()
+    for frame in frames[1:]:
+        mask = changed_mask(frame, reference, threshold)
+        bbox = mask.getbbox()
+        if bbox is None: # nothing has changed, still the frame is needed for the timing
+            bbox = (0, 0, 1, 1)
+            mask = Image.new("L", frame.size, 0)
+
+        delta = Image.new("P", (bbox[2] - bbox[0], bbox[3] - bbox[1]), TRANSPARENT_INDEX)
+        delta.putpalette(palette_img.getpalette())
+        delta.paste(frame.crop(bbox).quantize(palette=palette_img), (0, 0), mask.crop(bbox))
+        out.append(frame_blocks(delta, bbox[:2], delay_ms, TRANSPARENT_INDEX))
+
+        reference.paste(frame, (0, 0), mask)
+
+    out.append(";")
+    return "".join(out)
+
+def write(file_name, frames, delay_ms, loop=LOOP_FOREVER):
+    data = encode(frames, delay_ms, loop)
+    with open(file_name, "wb") as gif_file:
+        gif_file.write(data)
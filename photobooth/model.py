@@ -5,7 +5,9 @@ import datetime
 import random
 import math
 
-from upload import get_stamp_filename
+from upload import get_uploaded_url
+from sessionindex import SessionIndex
+import atlas
 
 import logging
 logger = logging.getLogger('photobooth.%s' % __name__)
@@ -87,14 +89,15 @@ class TakePictureState(SessionState):
 
         # if this is the last image, do not fire up the live view after the shoot
         if self.model.photo_count == 4:
-            self.model.controller.schedule_stop_live_view(self.model.images[1][1])
+            # the first image is shown as the still (or the last live view frame if it's not processed yet)
+            self.model.controller.schedule_stop_live_view(self.model.get_image(1, 1))
 
         logger.debug("TakePictureState: taking picutre: %s", image_name)
         self.model.controller.set_text(self.model.conf['m']['after_capture'][self.model.photo_count])
 
     def update(self, button_pressed):
         if self.model.photo_count == 4:
-            if self.model.photo_count in self.model.images: # wait for image to be taken before going futher
+            if self.model.images_ready(): # wait for images to be processed before going futher
                 return ShowSessionMontageState(self.model)
             else:
                 return self
@@ -118,7 +121,7 @@ class ShowSessionMontageState(TimedState):
     def __init__(self, model):
         super(ShowSessionMontageState, self).__init__(model, model.conf['control']['montage_display_secs'])
 
-        img_lv_list = [sizes[1] for sizes in self.model.images.itervalues()]
+        img_lv_list = self.model.get_images(1)
         self.model.controller.enqueue_animate_montage(img_lv_list)
 
         self.text_arr = self.model.conf['m']['during_merge'].strip().split("\n")
@@ -167,7 +170,9 @@ class PhotoSessionModel(object):
         self.session_start = time.time()
 
         self.images = dict()
+        self.placeholders = dict()
         self.href = None
+        self.finished_model = None
 
     def update(self, button_pressed):
         """ model updating func - transitins to next states """
@@ -180,10 +185,40 @@ class PhotoSessionModel(object):
         else:
             return not self.capture_start and time.time() - self.session_start > self.conf['control']['idle_secs']
 
+    def images_ready(self):
+        """ True when all 4 images have been captured and post-processed """
+        return len(self.images) == 4 and all(res.ready() for res in self.images.itervalues())
+
+    def get_image(self, num, size_idx):
+        """ post-processed image of a given size (1: medium, 2: prev) or None if it's not ready yet.
+        Never raises: the image which failed post-processing is replaced by a placeholder """
+        res = self.images.get(num)
+        if res is None or not res.ready():
+            return None
+        if res.successful():
+            return res.get()[size_idx]
+
+        if (num, size_idx) not in self.placeholders:
+            try:
+                res.get()
+            except Exception:
+                logger.exception("post-processing of image %d failed, using placeholder", num)
+            img_name = self.booth_model.get_image_name(self.id, num, ['full', 'medium', 'prev'][size_idx])
+            self.placeholders[(num, size_idx)] = self.controller.create_placeholder_image(size_idx, img_name)
+        return self.placeholders[(num, size_idx)]
+
+    def get_images(self, size_idx):
+        """ images of a given size (1: medium, 2: prev), only when images_ready() """
+        return [self.get_image(num, size_idx) for num in sorted(self.images)]
+
     def get_finished_session_model(self):
-        prev_images = [sizes[2] for sizes in self.images.itervalues()]
-        medium_images = [sizes[1] for sizes in self.images.itervalues()]
-        return FinishedSessionModel(self.booth_model, self.id, prev_images, medium_images, self.conf['random_tags'])
+        """ created once, so the random tags are the same for printing, uploading and the index """
+        if not self.finished_model:
+            prev_images = self.get_images(2)
+            medium_images = self.get_images(1)
+            self.finished_model = FinishedSessionModel(self.booth_model, self.id, prev_images, medium_images,
+                                                       self.conf['random_tags'])
+        return self.finished_model
 
     def finished(self):
         """ returns True if this session is finished """
@@ -191,21 +226,62 @@ class PhotoSessionModel(object):
 
 class FinishedSessionModel(object):
     """ finised session previews to be displayed in idle screen """
-    def __init__(self, booth_model, sess_id, img_list, medium_img_list, random_tags_conf):
+    # pylint: disable=too-many-arguments
+    def __init__(self, booth_model, sess_id, img_list, medium_img_list, random_tags_conf, random_tags=None):
         self.id = sess_id
         self.booth_model = booth_model
-        self.img_list = img_list
+        self._img_list = img_list
         self.medium_img_list = medium_img_list
-        self.random_tags = []
-        if random_tags_conf and random_tags_conf['enabled']:
+        self.atlas_rects = None
+        self.index_paths = None # img type -> paths relative to the event dir (from the session index)
+        if random_tags is not None:
+            self.random_tags = random_tags
+        elif random_tags_conf and random_tags_conf['enabled']:
             self.random_tags = random.sample(random_tags_conf['list'], random_tags_conf['count'])
-
+        else:
+            self.random_tags = []
+
+    @property
+    def img_list(self):
+        """
+        'prev' images - subsurfaces of the session atlas, loaded on first use
+        (only sessions shown on the idle screen need them)
+        """
+        if self._img_list is not None:
+            return self._img_list
+        try:
+            return self.booth_model.get_session_previews(self)
+        except Exception:
+            logger.warn("failed to load preview images of session %d", self.id)
+            return []
+
+    def release_img_list(self):
+        """ drop in-memory previews, img_list will be served from the atlas cache """
+        self._img_list = None
+
+    def get_img_paths(self, img_type):
+        """ image paths as recorded in the session index, derived from the session ID otherwise """
+        if self.index_paths and img_type in self.index_paths:
+            event_dir = self.booth_model.conf['event_dir']
+            return [os.path.join(event_dir, path) for path in self.index_paths[img_type]]
+        return [self.booth_model.get_image_name(self.id, photo_no, img_type) for photo_no in xrange(1, 5)]
+
+    def get_prev_img_paths(self):
+        return self.get_img_paths('prev')
 
     def get_medium_img_paths(self):
-        return [self.booth_model.get_image_name(self.id, photo_no, 'medium') for photo_no in xrange(1, 5)]
+        return self.get_img_paths('medium')
 
     def get_full_img_paths(self):
-        return [self.booth_model.get_image_name(self.id, photo_no, 'full') for photo_no in xrange(1, 5)]
+        return self.get_img_paths('full')
+
+    def get_index_paths(self):
+        """ image paths (relative to the event dir) to be stored in the session index """
+        event_dir = self.booth_model.conf['event_dir']
+        return dict((img_type, [os.path.relpath(path, event_dir) for path in paths]) for img_type, paths in [
+            ('prev', self.get_prev_img_paths()),
+            ('medium', self.get_medium_img_paths()),
+            ('full', self.get_full_img_paths())])
 
     def load_medium_images(self):
         for img_name in self.get_medium_img_paths():
@@ -217,18 +293,17 @@ class FinishedSessionModel(object):
                 raise ValueError # error while opening/reading file, incomplete photo session
 
     @classmethod
-    def from_dir(cls, booth_model, sess_id, conf):
-        """ trying to create FinishedSession from directory """
-        img_list = []
-        for num in xrange(1, 5):
-            img_name = booth_model.get_image_name(sess_id, num, 'prev')
-            try:
-                img = booth_model.controller.load_captured_image(img_name)
-                img_list.append(img)
-            except Exception:
-                raise ValueError # error while opening/reading file, incomplete photo session
+    def from_index(cls, booth_model, record, conf):
+        """ creating FinishedSession from the session index record, images will be loaded lazily """
+        sess = cls(booth_model, record['id'], None, [], conf['random_tags'], record.get('tags'))
+        sess.atlas_rects = record.get('atlas')
+        sess.index_paths = record.get('paths')
+        return sess
 
-        return cls(booth_model, sess_id, img_list, [], conf['random_tags']) # do not care about medium images
+    @staticmethod
+    def is_complete_dir(booth_model, sess_id):
+        """ checking if all of the session previews are present in the session directory """
+        return all(os.path.exists(booth_model.get_image_name(sess_id, num, 'prev')) for num in xrange(1, 5))
 
 
 class PhotoBoothModel(object):
@@ -242,44 +317,78 @@ class PhotoBoothModel(object):
         self.next_photo_session = 1
         self.finished_sessions = []
         self.is_first_session = True
+        self.session_index = SessionIndex(self.conf['event_dir'])
+        self.atlas_cache = atlas.AtlasCache(self.conf['control']['idle_previews_cnt'])
 
     def load_from_disk(self):
-        """ try to load FinishedSessions from the disk """
+        """ try to load FinishedSessions from the session index (without decoding any images) """
+        if not self.session_index.exists():
+            self.rebuild_session_index()
+
         all_sessions = []
         to_upload_sessions = []
-        for dirname in os.listdir(self.conf['event_dir']):
-            #logger.debug("SCANNING: '%s'" % d)
-            path = os.path.join(self.conf['event_dir'], dirname)
-            if os.path.isdir(path):
-                try:
-                    sess_id = int(dirname)
-                except ValueError:
-                    sess_id = None
-                if sess_id:
-                    try:
-                        sess = FinishedSessionModel.from_dir(self, sess_id, self.conf)
-                        if 'print_sess' in self.conf['debug'] and sess_id == self.conf['debug']['print_sess']:
-                            logger.info("printing session %d" % sess_id)
-                            sess.load_medium_images()
-                            self.controller.notify_finished_session(sess)
-
-                        all_sessions.append(sess)
-                        is_uploaded = os.path.exists(get_stamp_filename(path + "/"))
-                        if not is_uploaded:
-                            to_upload_sessions.append(sess)
-                        logger.info("PHOTO_SESS : '%s' = %s (uploaded: %s)", dirname, sess, is_uploaded)
-                    except ValueError:
-                        #logger.debug("\t%d: incomplete session" % sess_id)
-                        pass
-                    # even if it's incompelete, we can't reuse the ID
-                    self.next_photo_session = max(self.next_photo_session, sess_id + 1)
-
-        all_sessions.sort(key=lambda x: x.id)
-        to_upload_sessions.sort(key=lambda x: x.id)
+        for sess_id, record in sorted(self.session_index.read().iteritems()):
+            # even if it's incompelete, we can't reuse the ID
+            self.next_photo_session = max(self.next_photo_session, sess_id + 1)
+            if not record.get('complete'):
+                #logger.debug("\t%d: incomplete session" % sess_id)
+                continue
+
+            sess = FinishedSessionModel.from_index(self, record, self.conf)
+            if 'print_sess' in self.conf['debug'] and sess_id == self.conf['debug']['print_sess']:
+                logger.info("printing session %d" % sess_id)
+                sess.load_medium_images()
+                self.controller.notify_finished_session(sess)
+
+            all_sessions.append(sess)
+            is_uploaded = 'uploaded' in record or get_uploaded_url(self.get_session_dir(sess_id)) is not None
+            if not is_uploaded:
+                to_upload_sessions.append(sess)
+            logger.info("PHOTO_SESS : '%d' = %s (uploaded: %s)", sess_id, sess, is_uploaded)
+
         self.finished_sessions = all_sessions
         self.update_finished()
         return to_upload_sessions
 
+    def rebuild_session_index(self):
+        """ creating the session index from session directories (event from before the index existed) """
+        logger.info("rebuilding session index: %s", self.session_index.file_name)
+        sess_ids = []
+        for dirname in os.listdir(self.conf['event_dir']):
+            if os.path.isdir(os.path.join(self.conf['event_dir'], dirname)):
+                try:
+                    sess_ids.append(int(dirname))
+                except ValueError:
+                    pass
+
+        for sess_id in sorted(sess_ids):
+            if not FinishedSessionModel.is_complete_dir(self, sess_id):
+                self.session_index.append(sess_id)
+                continue
+
+            sess = FinishedSessionModel(self, sess_id, None, [], self.conf['random_tags'])
+            attrs = dict(complete=True, tags=sess.random_tags, paths=sess.get_index_paths())
+            uploaded_url = get_uploaded_url(self.get_session_dir(sess_id))
+            if uploaded_url:
+                attrs['uploaded'] = uploaded_url
+            self.session_index.append(sess_id, **attrs)
+
+    def get_session_previews(self, sess):
+        """ session 'prev' images from its atlas (creating the atlas if it does not exist yet) """
+        atlas_name = atlas.get_atlas_filename(self.get_session_dir(sess.id))
+        if sess.atlas_rects is None or not os.path.exists(atlas_name):
+            images = [self.controller.load_captured_image(img_name) for img_name in sess.get_prev_img_paths()]
+            self.save_session_atlas(sess, images)
+            self.session_index.append(sess.id, atlas=sess.atlas_rects)
+
+        return self.atlas_cache.get(sess.id, atlas_name, sess.atlas_rects)
+
+    def save_session_atlas(self, sess, images):
+        """ packing session previews into the atlas, saving and caching it """
+        atlas_surface, sess.atlas_rects = atlas.pack(images)
+        atlas.save(atlas_surface, atlas.get_atlas_filename(self.get_session_dir(sess.id)))
+        self.atlas_cache.put(sess.id, atlas_surface, sess.atlas_rects)
+
     def update(self, button_pressed):
         """ updates current session """
         if self.current_sess:
@@ -293,10 +402,12 @@ class PhotoBoothModel(object):
             if button_pressed:
                 self.start_new_session()
 
-    def set_current_session_imgs(self, image_number, images):
+    def set_current_session_imgs(self, image_number, images_result):
         """ add new images to the current session
-        (used by the controller after image capture) """
-        self.current_sess.images[image_number] = images
+        (used by the controller after image capture, images_result is AsyncResult
+        of the post-processing yielding (full, medium, prev) images,
+        full-size image is not kept in memory and is always None) """
+        self.current_sess.images[image_number] = images_result
 
     def get_session_dir(self, sess_id):
         """ get session dir name """
@@ -318,6 +429,7 @@ class PhotoBoothModel(object):
         """ work to be done when new session starts """
         logging.debug("PhotoSession START")
         os.mkdir(self.get_session_dir(self.next_photo_session))
+        self.session_index.append(self.next_photo_session) # reserve the ID
         self.current_sess = PhotoSessionModel(self, self.next_photo_session)
         self.next_photo_session += 1
         self.controller.view.idle = False
@@ -332,7 +444,13 @@ class PhotoBoothModel(object):
         self.controller.lights.pause()
 
         if self.current_sess.finished():
-            self.finished_sessions.append(self.current_sess.get_finished_session_model())
+            finished_sess = self.current_sess.get_finished_session_model()
+            # from now on the previews will be served from the atlas
+            self.save_session_atlas(finished_sess, finished_sess.img_list)
+            finished_sess.release_img_list()
+            self.session_index.append(finished_sess.id, complete=True, tags=finished_sess.random_tags,
+                                      paths=finished_sess.get_index_paths(), atlas=finished_sess.atlas_rects)
+            self.finished_sessions.append(finished_sess)
             self.update_finished()
         self.current_sess = None
         self.controller.stop_live_view()
@@ -341,6 +459,7 @@ class PhotoBoothModel(object):
     def update_finished(self):
         """ update idle previews with finished sessions """
         self.finished_sessions = self.finished_sessions[-self.conf['control']['idle_previews_cnt']:]
+        self.atlas_cache.retain(set(sess.id for sess in self.finished_sessions))
         #logger.info("FINISED SESSIONS CNT: %d", len(self.finished_sessions))
         self.controller.notify_idle_previews_changed()
 
@@ -0,0 +1,53 @@
+# encoding: utf-8
+"""
+Persistent, append-only index of the photo sessions of the event.
+
+Every line of the index file is a JSON record with session 'id' and some of the session attributes
+('complete', 'tags', 'paths', 'uploaded', 'upload_done'). Later records update the earlier ones,
+so the state of the whole event can be read at startup without listing and decoding session directories.
+"""
+import os
+import json
+
+import logging
+logger = logging.getLogger('photobooth.%s' % __name__)
+
+INDEX_FILENAME = "sessions.idx"
+
+def get_index_filename(event_dir):
+    return os.path.join(event_dir, INDEX_FILENAME)
+
+class SessionIndex(object):
+    """ reading and appending session records (safe to be used by multiple processes) """
+
+    def __init__(self, event_dir):
+        self.file_name = get_index_filename(event_dir)
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def append(self, sess_id, **attrs):
+        """ appends single record, small appends are atomic so there is no need for locking """
+        attrs['id'] = sess_id
+        with open(self.file_name, 'a') as index_file:
+            index_file.write(json.dumps(attrs) + "\n")
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+    def read(self):
+        """ returns dict: session id -> merged session record """
+        sessions = dict()
+        if not self.exists():
+            return sessions
+
+        with open(self.file_name, 'r') as index_file:
+            for line_no, line in enumerate(index_file, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # most probably partially written last line (power failure)
+                    logger.warn("%s:%d: malformed session record, skipping", self.file_name, line_no)
+                    continue
+                sessions.setdefault(record['id'], dict()).update(record)
+
+        return sessions
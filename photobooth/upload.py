@@ -1,15 +1,36 @@
 # encoding: utf-8
+"""
+Uploader process: session GIF creation, Tumblr post and Dropbox share/upload.
+
+Every session is an upload job with its state persisted in the session directory (JSON, replaced
+atomically after every finished stage), so nothing is done twice and unfinished jobs are resumed
+after a restart. The stages have their own worker threads and are run in parallel for different
+sessions (eg. Tumblr post of one session during Dropbox upload of another one), the number of
+concurrent requests is bounded per destination (upload.concurrency).
+
+Stages and their dependencies:
+    gif    - animated GIF of the medium images
+    share  - Dropbox session folder + share link
+    tumblr - Tumblr post (needs gif, share), short URL is sent back to the booth
+    files  - Dropbox upload of the GIF and full-size images (needs gif, share), chunked and resumable
+"""
 import pytumblr
 import dropbox
 import time
 import os
-import subprocess
+import json
+from threading import Thread, Lock, Semaphore, Timer, local
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+from photobooth.sessionindex import SessionIndex
+from photobooth import gif
 
 import logging
 logger = logging.getLogger('photobooth.%s' % __name__)
 
 GIF_FILENAME = "animation.gif"
-STAMP_FILENAME = ".stamp_uploaded"
+STAMP_FILENAME = ".stamp_uploaded" # legacy 'uploaded' marker, replaced by the job file
+JOB_FILENAME = ".upload_job"
 
 def get_gif_filename(file_name):
     return os.path.join(os.path.dirname(file_name), GIF_FILENAME)
@@ -17,9 +38,24 @@ def get_gif_filename(file_name):
 def get_stamp_filename(file_name):
     return os.path.join(os.path.dirname(file_name), STAMP_FILENAME)
 
+def get_job_filename(sess_dir):
+    return os.path.join(sess_dir, JOB_FILENAME)
+
 def get_sess_dirname(conf, sess_id):
     return os.path.join(conf['event_dir'], conf['m']['upload_session_dir'] % sess_id)
 
+def get_uploaded_url(sess_dir):
+    """ short URL of the uploaded session (from the job file or the legacy stamp) or None """
+    job_filename = get_job_filename(sess_dir)
+    if os.path.exists(job_filename):
+        return UploadJob.load(job_filename).state.get('short_url')
+
+    stamp_filename = get_stamp_filename(sess_dir + "/")
+    if os.path.exists(stamp_filename):
+        with open(stamp_filename) as stamp_file:
+            return stamp_file.read()
+    return None
+
 def setup_dropbox_client(conf):
     """ Setuping dropbox client and basic folder structure """
     if not 'dropbox' in conf['upload'] or not conf['upload']['dropbox']['enabled']:
@@ -49,101 +85,350 @@ def setup_dropbox_client(conf):
 
     return db_client
 
-def run(conf, pipe):
-    """ we expect file list to be turned into GIF and uploaded """
-    logger.info("uploader process has started")
-    serv_pipe, client_pipe = pipe
-    serv_pipe.close()
-
-    # setup tumblr client
-    client = pytumblr.TumblrRestClient(
+def setup_tumblr_client(conf):
+    return pytumblr.TumblrRestClient(
         conf['upload']['tumblr']['consumer_key'],
         conf['upload']['tumblr']['consumer_secret'],
         conf['upload']['tumblr']['oauth_token'],
         conf['upload']['tumblr']['oauth_token_secret'],
     )
 
+
+class UploadJob(object):
+    """ upload state of a single session, saved after every change """
+
+    def __init__(self, file_name, state):
+        self.file_name = file_name
+        self.state = state
+        self.lock = Lock()
+        self.medium_frames = None # raw medium images passed by the booth (not persisted)
+        self.scheduled = set() # stages waiting or running
+
+    @classmethod
+    def create(cls, file_name, sess_id, medium_file_list, full_file_list, tags):
+        job = cls(file_name, dict(id=sess_id, medium_files=medium_file_list, full_files=full_file_list,
+                                  tags=tags, uploaded_files=[], files_progress=dict()))
+        job.save()
+        return job
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as job_file:
+            state = json.load(job_file)
+        state.setdefault('files_progress', dict())
+        return cls(file_name, state)
+
+    @property
+    def id(self):
+        return self.state['id']
+
+    @property
+    def gif_name(self):
+        return get_gif_filename(self.state['medium_files'][0])
+
+    def is_complete(self):
+        """ all of the stages have been done (regardless of the destinations enabled now) """
+        return all(self.state.get(key) for _, _, key in UploadQueue.STAGES)
+
+    def update(self, **attrs):
+        with self.lock:
+            self.state.update(attrs)
+            self.save()
+
+    def set_file_progress(self, file_name, **progress):
+        """ partial upload state of the single file """
+        with self.lock:
+            self.state['files_progress'][file_name] = progress
+            self.save()
+
+    def add_uploaded_file(self, file_name):
+        with self.lock:
+            self.state['files_progress'].pop(file_name, None)
+            self.state['uploaded_files'].append(file_name)
+            self.save()
+
+    def save(self):
+        """ replacing the file atomically - the old or the new state survives a crash """
+        tmp_name = self.file_name + ".tmp"
+        with open(tmp_name, 'w') as job_file:
+            json.dump(self.state, job_file)
+            job_file.flush()
+            os.fsync(job_file.fileno())
+        os.rename(tmp_name, self.file_name)
+
+
+class UploadQueue(object):
+    """ per-stage worker threads, concurrent requests bounded per destination """
+    STAGES = (
+        # name, destination, state key marking the stage as done
+        ('gif', 'gif', 'gif'),
+        ('share', 'dropbox', 'share_url'),
+        ('tumblr', 'tumblr', 'short_url'),
+        ('files', 'dropbox', 'files_done'),
+    )
+
+    def __init__(self, conf, client_pipe, dropbox_enabled):
+        self.conf = conf
+        self.client_pipe = client_pipe
+        self.pipe_lock = Lock()
+        self.dropbox_enabled = dropbox_enabled
+        self.sess_index = SessionIndex(conf['event_dir'])
+        self.jobs = dict()
+
+        # full-size files of all sessions are uploaded by one pool, every pool thread has its own client
+        self.files_pool = ThreadPool(conf['upload']['dropbox']['files_in_flight'])
+        self.files_clients = local()
+
+        limits = conf['upload']['concurrency']
+        self.destinations = dict((dest, Semaphore(limit)) for dest, limit in limits.iteritems())
+        self.queues = dict()
+        for name, dest, _ in self.STAGES:
+            self.queues[name] = Queue()
+            for _ in xrange(limits[dest]):
+                thread = Thread(target=self.stage_worker, args=(name, dest))
+                thread.setDaemon(True)
+                thread.start()
+
+    def submit(self, job):
+        """ new or resumed job (the same session is processed only once at the time) """
+        if job.id in self.jobs:
+            logger.debug("sess(%d) upload is already in progress", job.id)
+            return
+        self.jobs[job.id] = job
+        self.advance(job)
+
+    def is_done(self, job, stage):
+        if stage in ('share', 'files') and not self.dropbox_enabled:
+            return True
+        key = [key for name, _, key in self.STAGES if name == stage][0]
+        return bool(job.state.get(key))
+
+    def is_finished(self, job):
+        return all(self.is_done(job, name) for name, _, _ in self.STAGES)
+
+    def advance(self, job):
+        """ schedules all of the stages which can be run now """
+        with job.lock:
+            ready = []
+            for name, _, _ in self.STAGES:
+                if name in job.scheduled or self.is_done(job, name):
+                    continue
+                if name in ('tumblr', 'files') and not (self.is_done(job, 'gif') and self.is_done(job, 'share')):
+                    continue
+                job.scheduled.add(name)
+                ready.append(name)
+
+            finished = self.is_finished(job)
+
+        for name in ready:
+            self.queues[name].put(job)
+
+        if finished and self.jobs.pop(job.id, None):
+            logger.info("uploading sess(%d) has finished", job.id)
+            if job.is_complete():
+                self.sess_index.append(job.id, upload_done=True)
+
+    def stage_worker(self, stage, dest):
+        """ Thread: runs single stage of the queued jobs """
+        stage_func = getattr(self, "run_" + stage)
+        clients = dict() # API clients are not shared between threads
+        while True:
+            job = self.queues[stage].get()
+            start = time.time()
+            try:
+                with self.destinations[dest]:
+                    stage_func(job, clients)
+                logger.debug("sess(%d) %s time: %f seconds", job.id, stage, time.time() - start)
+            except Exception:
+                logger.exception("sess(%d) %s failed, retrying in %d seconds", job.id, stage,
+                                 self.conf['upload']['retry_secs'])
+                retry = Timer(self.conf['upload']['retry_secs'], self.queues[stage].put, (job,))
+                retry.setDaemon(True)
+                retry.start()
+                continue
+
+            with job.lock:
+                job.scheduled.discard(stage)
+            self.advance(job)
+
+    def get_client(self, clients, dest):
+        if dest not in clients:
+            if dest == 'tumblr':
+                clients[dest] = setup_tumblr_client(self.conf)
+            else:
+                clients[dest] = dropbox.client.DropboxClient(self.conf['upload']['dropbox']['access_token'])
+        return clients[dest]
+
+    def run_gif(self, job, clients):
+        """ create GIF (or do noting if it exists) """
+        gif_name = job.gif_name
+        if not os.path.exists(gif_name):
+            # medium images are passed as raw RGB by the booth, only the reuploaded sessions are read from disk
+            if job.medium_frames:
+                frames = gif.frames_from_raw(*job.medium_frames)
+            else:
+                frames = gif.frames_from_files(job.state['medium_files'])
+            gif.write(gif_name + ".tmp", frames, self.conf['control']['gif_delay_ms'])
+            os.rename(gif_name + ".tmp", gif_name)
+        job.medium_frames = None
+        job.update(gif=True)
+
+    def run_share(self, job, clients):
+        """ prepare dropbox folder for the session """
+        db_client = self.get_client(clients, 'dropbox')
+        sess_dir = get_sess_dirname(self.conf, job.id)
+        try:
+            db_client.file_create_folder(sess_dir)
+        except dropbox.rest.ErrorResponse, ex:
+            if ex.status != 403: # already created by the previous attempt
+                raise
+        shared = db_client.share(sess_dir)
+        logger.debug("dropbox_share: %s", shared)
+        job.update(share_url=shared['url'])
+
+    def run_tumblr(self, job, clients):
+        """ upload only the GIF, the post is created only once """
+        client = self.get_client(clients, 'tumblr')
+        blogname = self.conf['upload']['tumblr']['blogname']
+        if not job.state.get('post_id'):
+            caption = (u"<h1>" + self.conf['m']['upload_session_title'] + "</h1>") % job.id
+            if self.dropbox_enabled:
+                caption += u"<a href=\"%s\">%s</a>" % (job.state['share_url'], self.conf['m']['upload_download_photos'])
+            post = client.create_photo(blogname, state="published", tags=job.state['tags'], data=job.gif_name,
+                                       caption=caption, format="html")
+            logger.debug("create_photo: %s", post)
+            if not post or not 'id' in post:
+                raise Exception("Thumblr post failure: %s" % post)
+            job.update(post_id=post['id'])
+
+        # retrieve and send the short_url ASAP
+        created_post = client.posts(blogname, id=job.state['post_id'])
+        logger.debug("posts: %s", created_post)
+        short_url = created_post['posts'][0]['short_url']
+        logger.debug("short URL: %s", short_url)
+        try:
+            with self.pipe_lock:
+                self.client_pipe.send((job.id, short_url))
+        except IOError:
+            logger.warn("sess(%d): could not send short URL to the booth", job.id)
+
+        job.update(short_url=short_url)
+        self.sess_index.append(job.id, uploaded=short_url)
+
+    def run_files(self, job, clients):
+        """ reupload GIF + upload full-size images onto dropbox, several files at once (by the files pool) """
+        sess_dir = get_sess_dirname(self.conf, job.id)
+        to_upload = [img for img in [job.gif_name] + job.state['full_files'] if img not in job.state['uploaded_files']]
+
+        start = time.time()
+        sent = sum(self.files_pool.map(lambda img: self.upload_file(job, img, sess_dir + "/" + os.path.basename(img)),
+                                       to_upload))
+
+        elapsed = time.time() - start
+        logger.info("sess(%d) dropbox: %d files, %.1f MB in %.1f s (%.0f kB/s)", job.id, len(to_upload),
+                    sent / 1048576., elapsed, sent / 1024. / max(elapsed, 0.001))
+        job.update(files_done=True)
+
+    def upload_file(self, job, img, dest_file):
+        """
+        Files pool thread: chunked upload (Dropbox upload session), every chunk's offset is saved in the job,
+        so the upload of the big file continues after a restart. Returns number of bytes sent.
+        """
+        if not hasattr(self.files_clients, 'clients'):
+            self.files_clients.clients = dict()
+        db_client = self.get_client(self.files_clients.clients, 'dropbox')
+        chunk_size = self.conf['upload']['dropbox']['chunk_size_kb'] * 1024
+        size = os.path.getsize(img)
+        logger.debug("Dropbox: uploading file to: %s", dest_file)
+
+        if size <= chunk_size: # single request, nothing to resume
+            with open(img, "rb") as up_file:
+                db_client.put_file(dest_file, up_file, overwrite=True)
+            job.add_uploaded_file(img)
+            return size
+
+        progress = job.state['files_progress'].get(img, {})
+        offset, upload_id = progress.get('offset', 0), progress.get('upload_id')
+        if offset:
+            logger.info("Dropbox: resuming upload of %s at %d/%d", img, offset, size)
+
+        sent = 0
+        restarted = False
+        with open(img, "rb") as up_file:
+            while offset < size:
+                up_file.seek(offset)
+                chunk = up_file.read(chunk_size)
+                try:
+                    offset, upload_id = db_client.upload_chunk(chunk, len(chunk), offset, upload_id)
+                except dropbox.rest.ErrorResponse, ex:
+                    # expired upload session or offset mismatch - start over (only once)
+                    if upload_id and ex.status in (400, 404) and not restarted:
+                        logger.warn("Dropbox: restarting upload of %s (%s)", img, ex)
+                        offset, upload_id, restarted = 0, None, True
+                        continue
+                    raise
+                sent += len(chunk)
+                job.set_file_progress(img, offset=offset, upload_id=upload_id)
+
+        db_client.commit_chunked_upload(dest_file, upload_id, overwrite=True)
+        job.add_uploaded_file(img)
+        return sent
+
+
+def find_pending_jobs(conf, is_finished):
+    """
+    unfinished jobs from the previous runs; completely uploaded sessions are recorded in the session index,
+    so their job files are not read again on the next startups
+    """
+    sess_index = SessionIndex(conf['event_dir'])
+    done_ids = set(sess_id for sess_id, record in sess_index.read().iteritems() if record.get('upload_done'))
+    jobs = []
+    for dirname in sorted(os.listdir(conf['event_dir'])):
+        if dirname.isdigit() and int(dirname) in done_ids:
+            continue
+        job_filename = get_job_filename(os.path.join(conf['event_dir'], dirname))
+        if not os.path.exists(job_filename):
+            continue
+        try:
+            job = UploadJob.load(job_filename)
+        except ValueError:
+            logger.warn("malformed upload job, skipping: %s", job_filename)
+            continue
+
+        if not is_finished(job):
+            jobs.append(job)
+        elif job.is_complete(): # finished before the index recorded it
+            sess_index.append(job.id, upload_done=True)
+    return jobs
+
+def run(conf, pipe):
+    """ we expect file list to be turned into GIF and uploaded """
+    logger.info("uploader process has started")
+    serv_pipe, client_pipe = pipe
+    serv_pipe.close()
+
     db_client = setup_dropbox_client(conf)
+    upload_queue = UploadQueue(conf, client_pipe, db_client is not None)
+
+    if conf['upload']['retrying']:
+        for job in find_pending_jobs(conf, upload_queue.is_finished):
+            upload_queue.submit(job)
 
     while True:
         try:
-            sess_id, medium_file_list, full_file_list, tags = client_pipe.recv()
+            sess_id, medium_file_list, full_file_list, tags, medium_frames = client_pipe.recv()
         except EOFError:
             break
         except IOError:
             break
 
-        try:
-            logger.info("processing sess(%d) files: %s", sess_id, full_file_list)
-
-            # (1) create GIF (or do noting if it exists)
-            start = time.time()
-            gif_name = get_gif_filename(medium_file_list[0])
-            if not os.path.exists(gif_name):
-                # GIF dealy is in 'ticks' (100 ticks = 1 s)
-                cmd = ["convert", "-delay", str(conf['control']['gif_delay_ms']/10), "-loop", "0"]
-                cmd.extend(medium_file_list)
-                cmd.append(gif_name)
-                logger.debug("CMD: %s", cmd)
-                subprocess.call(cmd)
-                logger.debug("creating GIF took %f seconds", (time.time() - start))
-
-            # (2) prepare dropbox folder for the session
-            if db_client:
-                start = time.time()
-                sess_dir = get_sess_dirname(conf, sess_id)
-                db_client.file_create_folder(sess_dir)
-                shared = db_client.share(sess_dir)
-                logger.debug("dropbox_share: %s", shared)
-                logger.debug("dropbox_share time: %f seconds", (time.time() - start))
-
-            # (3) upload only the GIF
-            start = time.time()
-            caption = (u"<h1>" + conf['m']['upload_session_title'] + "</h1>") % sess_id
-            if db_client:
-                caption += u"<a href=\"%s\">%s</a>" % (shared['url'], conf['m']['upload_download_photos'])
-            post = client.create_photo(conf['upload']['tumblr']['blogname'], state="published", tags=tags, data=gif_name, caption=caption, format="html")
-            logger.debug("create_photo: %s", post)
-            logger.debug("create_photo time: %f seconds", (time.time() - start))
-            if not post or not 'id' in post:
-                logging.error("Thumblr post failure. Aborting this session.")
-                continue
-
-            # (4) retrieve and send the short_url ASAP
-            start = time.time()
-            created_post = client.posts(conf['upload']['tumblr']['blogname'], id=post['id'])
-            logger.debug("posts: %s", created_post)
-            logger.debug("posts time: %f seconds", (time.time() - start))
-            short_url = created_post['posts'][0]['short_url']
-            logger.debug("short URL: %s", short_url)
-            client_pipe.send((sess_id, short_url))
-
-            # (5) write stamp file to ensure we've sent data to tumblr
-            with open(get_stamp_filename(gif_name), 'w') as stamp_file:
-                stamp_file.write(short_url)
-
-            # (6) reupload GIF + upload remaining files onto dropbox
-            if db_client:
-                start = time.time()
-                imgs_to_upload = [gif_name]
-                imgs_to_upload.extend(full_file_list)
-                for img in imgs_to_upload:
-                    up_file = open(img, "rb")
-                    dest_file = sess_dir + "/" + os.path.basename(img)
-                    logging.debug("Dropbox: uploading file to: %s", dest_file)
-                    db_client.put_file(dest_file, up_file)
-                logger.debug("dropbox_upload time: %f seconds", (time.time() - start))
-
-            # reuploading all images to tumblr - not used!
-            #start = time.time()
-            #imgs_to_upload = [gif_name]
-            #imgs_to_upload.extend(file_list)
-            #res = client.edit_post(config.tumblr_blogname, id=post['id'], data=imgs_to_upload)
-            #logger.debug("reupload result: %s", res)
-            #logger.debug("edit_post time: %f seconds", (time.time() - start))
-            logger.info("uploading sess(%d) has finished", sess_id)
-        except Exception:
-            logger.exception("Uploader worker exception!")
+        logger.info("processing sess(%d) files: %s", sess_id, full_file_list)
+        job_filename = get_job_filename(os.path.dirname(medium_file_list[0]))
+        if os.path.exists(job_filename):
+            job = UploadJob.load(job_filename)
+        else:
+            job = UploadJob.create(job_filename, sess_id, medium_file_list, full_file_list, tags)
+        job.medium_frames = medium_frames
+        upload_queue.submit(job)
 
     logger.info("uploader worker exiting!")
-
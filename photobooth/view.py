@@ -1,4 +1,8 @@
 import pygame
+import fonts
+import assets
+import animation
+import display
 
 import logging
 logger = logging.getLogger('photobooth.%s' % __name__)
@@ -25,12 +29,11 @@ class PhotoPreview(pygame.sprite.DirtySprite):
         self.rect.topleft = position
         self.image.convert()
 
-        # animation
+        # animation (timing is driven by the common animation clock)
         self.animate_idx = 0
         self.animate_file_list = None
         self.animate_file_list_len = 0
-        self.animate_change_every_ms = 0
-        self.animate_next_change = 0
+        self.animate_frame = None
 
         # overlay
         self.begin_overlay_animation_frames = []
@@ -46,26 +49,22 @@ class PhotoPreview(pygame.sprite.DirtySprite):
     def height(cls):
         return cls.HEIGHT + 2 * cls.BORDER
 
-    @staticmethod
-    def load_overlay_animation_frames(file_glob, begin, end, l):
-        for i in xrange(begin, end):
-            img = pygame.image.load(file_glob % i).convert_alpha()
-            l.append(img)
-
     def load_begin_overlay_animation_frames(self, file_glob, begin, end):
-        self.load_overlay_animation_frames(file_glob, begin, end, self.begin_overlay_animation_frames)
+        """ frames are shared between all of the previews """
+        self.begin_overlay_animation_frames = assets.load_frames(file_glob, begin, end, self.conf['view']['frames_raw_cache'])
 
     def load_end_overlay_animation_frames(self, file_glob, begin, end):
-        self.load_overlay_animation_frames(file_glob, begin, end, self.end_overlay_animation_frames)
+        """ frames are shared between all of the previews """
+        self.end_overlay_animation_frames = assets.load_frames(file_glob, begin, end, self.conf['view']['frames_raw_cache'])
 
     def begin_overlay(self):
         """ note: you cannot have an overlay over animation """
         self.is_overlay = True
-        self.start_animate(self.begin_overlay_animation_frames, 0)
+        self.start_animate(self.begin_overlay_animation_frames, self.conf['display']['overlay_anim_fps'])
 
     def end_overlay(self):
         self.is_overlay = True
-        self.start_animate(self.end_overlay_animation_frames, 0)
+        self.start_animate(self.end_overlay_animation_frames, self.conf['display']['overlay_anim_fps'])
 
     def draw_rect(self):
         """ draws empty rectangle with the number in the middle of it"""
@@ -77,9 +76,8 @@ class PhotoPreview(pygame.sprite.DirtySprite):
 
     def draw_number(self, number):
         """ draws a number in the middle of the surface """
-        font = pygame.font.SysFont(pygame.font.get_default_font(), self.conf['view']['big_font_size'])
-        fw, fh = font.size(str(number))
-        surface = font.render(str(number), True, self.conf['view']['font_color'])
+        surface = fonts.render(str(number), self.conf['view']['big_font_size'], self.conf['view']['font_color'])
+        fw, fh = surface.get_size()
         self.image.blit(surface, ((self.rect.width - fw) // 2, (self.rect.height - fh) // 2))
         #logger.debug("%s: draw_number()" % self)
         self.dirty = 1
@@ -93,21 +91,25 @@ class PhotoPreview(pygame.sprite.DirtySprite):
     def set_image(self, img):
         self.image_orig = img
 
+    def replace_image(self, img):
+        """ sets the image and redraws it immediately if there is no overlay animation running """
+        self.image_orig = img
+        if not self.is_overlay:
+            self.draw_image(img)
+
     def start_animate(self, file_list, fps):
-        """
-        Starts indefinately animating file list ala GIF.
-        if fps = 0 -> synchronize with display FPS
-        """
+        """ Starts indefinately animating file list ala GIF. """
+        if not file_list:
+            self.stop_animate()
+            return
         self.animate_file_list = file_list
         self.animate_file_list_len = len(file_list)
         self.animate_idx = 0
-        if fps == 0: # next frame every update()
-            self.animate_change_every_ms = 0
-        else:
-            self.animate_change_every_ms = 1000 / fps
+        animation.clock.start(self, fps)
 
     def stop_animate(self):
         self.animate_file_list = None
+        animation.clock.stop(self)
 
     def draw(self, canvas):
         if self.dirty:
@@ -118,19 +120,23 @@ class PhotoPreview(pygame.sprite.DirtySprite):
     def update(self, force_redraw=0):
         if force_redraw:
             self.dirty = 1
-        if self.image_orig and self.is_overlay:
+        if self.animate_file_list and animation.clock.is_due(self):
+            #logger.debug("ANIMATE: %d" % self.animate_idx)
+            self.animate_frame = self.animate_file_list[self.animate_idx]
+            self.animate_idx = (self.animate_idx + 1) % self.animate_file_list_len
+
+            if self.is_overlay:
+                self.draw_overlay_base()
+            self.draw_image(self.animate_frame)
+
+            if self.is_overlay and self.animate_idx == 0:
+                self.is_overlay = False
+                self.stop_animate()
+
+    def draw_overlay_base(self):
+        """ draws the image below the overlay animation frame """
+        if self.image_orig:
             self.draw_image(self.image_orig)
-        if self.animate_file_list:
-            if self.animate_next_change < pygame.time.get_ticks():
-                #logger.debug("ANIMATE: %d" % self.animate_idx)
-
-                self.draw_image(self.animate_file_list[self.animate_idx])
-                self.animate_idx = (self.animate_idx + 1) % self.animate_file_list_len
-
-                self.animate_next_change = pygame.time.get_ticks() + self.animate_change_every_ms
-                if self.is_overlay and self.animate_idx == 0:
-                    self.is_overlay = False
-                    self.stop_animate()
 
 
 class SmallPhotoPreview(PhotoPreview):
@@ -180,9 +186,8 @@ class LivePreview(PhotoPreview):
         self.load_begin_overlay_animation_frames("assets/shutter/big/shutter%02d.png", 0, 8)
         self.load_end_overlay_animation_frames("assets/shutter/big/shutter%02d.png", 8, 16)
         self._show_arrow = False
+        self.drawn_generation = None # live view frame currently on the surface
         self.arrow_img = self.get_arrow_overlay(conf)
-        self.arrow_rect = self.arrow_img.get_rect()
-        self.arrow_rect.center = (self.width() / 2, self.height() / 2)
 
         self.stop()
 
@@ -194,8 +199,7 @@ class LivePreview(PhotoPreview):
         pygame.draw.polygon(arrow, (255, 255, 255),
                 ((200, 300), (200, 200), (0, 200), (300, 0),
                     (600, 200), (400, 200), (400, 300)))
-        font = pygame.font.SysFont(pygame.font.get_default_font(), 100)
-        line = font.render(conf['m']['arrow_text'], True, (255, 255, 255))
+        line = fonts.get_font(100).render(conf['m']['arrow_text'], True, (255, 255, 255))
         line_pos = line.get_rect()
         line_pos.center = (w / 2, 350)
 
@@ -208,19 +212,25 @@ class LivePreview(PhotoPreview):
 
     @show_arrow.setter
     def show_arrow(self, val):
+        """ the arrow is blended into the live view frames by the camera """
+        if val == self._show_arrow:
+            return
         self._show_arrow = val
-        self.is_dirty = 1
-
-    def draw_flip_image(self, image, flip_image):
-        """ starts displaying image instead of empty rect """
-        #scalled = pygame.transform.scale(image, (LiveView.WIDTH, LiveView.HEIGHT))
-        if flip_image:
-            image = pygame.transform.flip(image, True, False)
-        super(LivePreview, self).draw_image(image)
+        # centered over the camera frame (which may be smaller than the preview)
+        self.camera.set_preview_overlay(self.arrow_img if val else None)
 
     def start(self):
         self.stop_animate()
         self.is_started = True
+        self.drawn_generation = None
+
+    def draw_overlay_base(self):
+        """ overlay is being drawn over the live view frame if the live view is running """
+        if self.is_started:
+            self.draw_image(self.camera.capture_preview())
+            self.drawn_generation = self.camera.preview_generation
+        else:
+            super(LivePreview, self).draw_overlay_base()
 
     def stop(self):
         self.is_started = False
@@ -231,15 +241,26 @@ class LivePreview(PhotoPreview):
         self.is_started = False
         # do not overwrite with black rectangle
 
+    def freeze(self):
+        """ stops with the last live view frame kept on the screen (and below the overlay animation) """
+        self.is_started = False
+        self.set_image(self.camera.capture_preview().copy()) # the camera reuses its frame buffers
+
     def enqueue_animate_montage(self, img_list, fps):
         self.enqueued_anim = (img_list, fps)
         self.set_image(img_list[-1])
 
     def update(self, force_redraw=0):
         if self.is_started:
-            self.draw_flip_image(self.camera.capture_preview(), self.conf['view']['flip_preview'])
-            if self.show_arrow:
-                self.image.blit(self.arrow_img, self.arrow_rect)
+            # frames are already mirrored and blended with the arrow by the camera, just blit them
+            image = self.camera.capture_preview()
+            # unchanged frame costs nothing
+            generation = self.camera.preview_generation
+            if generation != self.drawn_generation or force_redraw:
+                self.drawn_generation = generation
+                self.draw_image(image)
+                if self.is_overlay and self.animate_frame:
+                    self.draw_image(self.animate_frame) # keep the overlay over the new frame
         elif self.enqueued_anim and not self.is_overlay:
             img_list, fps = self.enqueued_anim
             self.enqueued_anim = None
@@ -258,8 +279,8 @@ class TextBox(PhotoPreview):
 
     def __init__(self, group, conf, size, center):
         super(TextBox, self).__init__(group, conf, (size[0], self.HEIGHT), center, self.BORDER)
-        self.font = pygame.font.SysFont(pygame.font.get_default_font(), self.conf['view']['font_size'])
-        self.big_font = pygame.font.SysFont(pygame.font.get_default_font(), self.conf['view']['big_font_size'])
+        self.font_size = self.conf['view']['font_size']
+        self.big_font_size = self.conf['view']['big_font_size']
 
         # surface & positioning
         #self.image = pygame.Surface(size)
@@ -278,13 +299,13 @@ class TextBox(PhotoPreview):
             return
 
         if big_font:
-            font = self.big_font
+            font_size = self.big_font_size
         else:
-            font = self.font
+            font_size = self.font_size
 
         self.current_text = text
         self.image.fill((0, 0, 0))
-        line = font.render(text, True, self.conf['view']['font_color'])
+        line = fonts.render(text, font_size, self.conf['view']['font_color'])
         line_pos = line.get_rect()
         line_pos.center = (self.rect.width / 2, self.rect.height / 2)
 
@@ -298,6 +319,52 @@ class TextBox(PhotoPreview):
             return self.rect
 
 
+class StatsOverlay(pygame.sprite.DirtySprite):
+    """
+    Debug: render FPS (frames actually presented) vs source FPS (new live view frames) in the screen corner
+    """
+    SIZE = (360, 24)
+
+    def __init__(self, conf):
+        super(StatsOverlay, self).__init__()
+        self.conf = conf
+        self.image = pygame.Surface(self.SIZE).convert()
+        self.rect = self.image.get_rect()
+        self.font = fonts.get_font(self.SIZE[1])
+        self.dirty = 0
+
+        self.presented_frames = 0
+        self.source_generation = 0
+        self.next_update_ticks = 0
+
+    def update(self, presented, source_generation):
+        """ count presented frame, recalculate the rates every fps_update_ms """
+        if presented:
+            self.presented_frames += 1
+
+        now = pygame.time.get_ticks()
+        if now < self.next_update_ticks:
+            return
+
+        period_s = self.conf['debug']['fps_update_ms'] / 1000.
+        render_fps = self.presented_frames / period_s
+        source_fps = (source_generation - self.source_generation) / period_s
+        self.presented_frames = 0
+        self.source_generation = source_generation
+        self.next_update_ticks = now + self.conf['debug']['fps_update_ms']
+
+        self.image.fill((0, 0, 0))
+        line = self.font.render("render: %.1f FPS, source: %.1f FPS" % (render_fps, source_fps), True, (255, 255, 255))
+        self.image.blit(line, (2, 2))
+        self.dirty = 1
+
+    def draw(self, canvas):
+        if self.dirty:
+            self.dirty = 0
+            canvas.blit(self.image, self.rect)
+            return self.rect
+
+
 class PygView(object):
     """
     Main view which handles all of the rendering.
@@ -312,8 +379,9 @@ class PygView(object):
         self.camera = camera
         self.controller = controller
 
-        flags = pygame.DOUBLEBUF | [0, pygame.FULLSCREEN][self.conf['display']['fullscreen']]
-        self.canvas = pygame.display.set_mode((self.conf['display']['screen_width'], self.conf['display']['screen_height']), flags)
+        self.display = display.create(self.conf)
+        self.canvas = self.display.canvas
+        logger.info("display backend: %s", self.display.name)
         if self.conf['view']['back_image']:
             image = pygame.image.load(self.conf['view']['back_image'])
             self.back_image = pygame.transform.scale(image, (self.conf['display']['screen_width'], self.conf['display']['screen_height']))
@@ -332,6 +400,9 @@ class PygView(object):
         self.idleview_group.set_timing_treshold(1000. / self.conf['display']['idle_fps'])
 
         self.init_child_components()
+        self.stats = None
+        if self.conf['debug']['show_stats']:
+            self.stats = StatsOverlay(self.conf)
         self.fps = self.conf['display']['idle_fps']
         self.idle = True
 
@@ -382,6 +453,13 @@ class PygView(object):
         self.idle_textbox = TextBox(self.idleview_group, self.conf, (idle_total_width, TextBox.height()), (screen_width / 2, top_offset + TextBox.height() / 2))
         self.idle_textbox.draw_text(self.conf['m']['idle_pushbutton'])
 
+        # render texts displayed during the session only once
+        countdown_secs = max(self.conf['control']['initial_countdown_secs'], self.conf['control']['midphoto_countdown_secs'])
+        fonts.prerender([u"%d" % num for num in xrange(1, countdown_secs + 1)],
+                        self.conf['view']['big_font_size'], self.conf['view']['font_color'])
+        fonts.prerender(self.conf['m']['during_merge'].strip().split("\n"),
+                        self.conf['view']['font_size'], self.conf['view']['font_color'])
+
 
     @property
     def idle(self):
@@ -393,7 +471,7 @@ class PygView(object):
         #logger.info("Idle: %s", val)
         self.canvas.blit(self.back_image, (0, 0))
         # ensure we will update full screen, not only dirty rects
-        pygame.display.flip()
+        self.display.flip()
         if self.is_idle:
             self.idleview_group.update(1) # force_redraw = 1
             self.fps = self.conf['display']['idle_fps']
@@ -405,7 +483,12 @@ class PygView(object):
             self.fps = self.conf['display']['working_fps']
 
 
+    def next_frame_delay(self):
+        """ milliseconds until the next animation frame on the idle screen is due (None if nothing animates) """
+        return animation.clock.time_to_next_due(self.idle_previews.values())
+
     def update(self):
+        animation.clock.tick()
         dirty_rects = []
         if self.is_idle:
             self.idleview_group.update(0)
@@ -419,7 +502,15 @@ class PygView(object):
             dirty_rects += [pp.draw(self.canvas) for pp in self.main_previews.values()]
             dirty_rects += [self.textbox.draw(self.canvas)]
 
+        # nothing has changed (e.g. live view frame is the same as the last one) - do not touch the display
+        dirty_rects = [rect for rect in dirty_rects if rect]
+        if self.stats:
+            self.stats.update(len(dirty_rects) > 0, self.camera.preview_generation)
+            if dirty_rects or self.stats.dirty:
+                dirty_rects.append(self.stats.draw(self.canvas))
+
         #logger.debug("DIRTY RECTS: %s" % dirty_rects)
-        pygame.display.update(dirty_rects)
+        if dirty_rects:
+            self.display.update(dirty_rects)
 
 
@@ -1,3 +1,5 @@
+import platform
+
 PI      = "pi"
 LINUX   = "linux"
 UNKNOWN = "unknown"
@@ -0,0 +1,160 @@
+# encoding: utf-8
+"""
+Remuxing picam's MPEG-TS recordings to MP4 - either the whole file after the recording
+or streamed while picam is still recording (fragmented MP4, no index to be written at the end)
+"""
+import os
+import subprocess
+import time
+
+from threading import Thread, Lock, Event
+
+import logging
+logger = logging.getLogger('videobooth.%s' % __name__)
+
+PART_SUFFIX = ".part"
+POLL_SECS = 0.1
+READ_CHUNK = 256 * 1024
+COPY_ARGS = ['-c:v', 'copy', '-c:a', 'copy', '-bsf:a', 'aac_adtstoasc']
+FRAGMENTED_MP4_ARGS = ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+
+def remux_file(src_path, dest_path):
+    """ remuxes the finished recording, returns ffmpeg's returncode """
+    cmd = ['ffmpeg', '-i', src_path] + COPY_ARGS + [dest_path]
+    logger.debug("CONVERT CMD: %s", cmd)
+    return subprocess.call(cmd)
+
+
+class FollowedRecording(object):
+    """ state of a single streaming remux """
+    def __init__(self):
+        self.finished = Event()
+        self.cancelled = False
+        self.proc = None
+
+
+class StreamingRemux(object):
+    """
+    Watches picam's rec/tmp dir for new recordings and pipes every one of them to ffmpeg as it grows.
+    picam moves the finished recording to rec/archive - the rest of the file is read, ffmpeg finishes
+    and <name>.mp4 appears in dest_dir (written as .part until then).
+    """
+    def __init__(self, rec_tmp_dir, dest_dir, stall_secs):
+        self.rec_tmp_dir = rec_tmp_dir
+        self.dest_dir = dest_dir
+        self.stall_secs = stall_secs
+
+        self.lock = Lock()
+        self.known_files = set()
+        self.followed = {} # name -> FollowedRecording
+        self.thread_watch = Thread(target=self.watch_worker)
+        self.thread_watch.setDaemon(True)
+
+    def list_recordings(self):
+        try:
+            return [f for f in os.listdir(self.rec_tmp_dir) if os.path.splitext(f)[1] == ".ts"]
+        except OSError:
+            return []
+
+    def start(self):
+        # leftovers of the previous run are not growing anymore
+        self.known_files.update(self.list_recordings())
+        self.thread_watch.start()
+
+    def wait(self, name):
+        """
+        waits for the streaming remux of the recording (if it was followed) to finish;
+        on timeout the streaming remux is cancelled - it never touches the MP4 afterwards
+        """
+        with self.lock:
+            followed = self.followed.pop(name, None)
+        if not followed or followed.finished.wait(self.stall_secs * 2):
+            return
+
+        logger.warn("streaming remux of '%s' has not finished in time, cancelling", name)
+        with self.lock:
+            followed.cancelled = True
+            if followed.proc:
+                try:
+                    followed.proc.kill()
+                except OSError:
+                    pass
+
+    def watch_worker(self):
+        while True:
+            for filename in self.list_recordings():
+                if filename in self.known_files:
+                    continue
+                self.known_files.add(filename)
+
+                followed = FollowedRecording()
+                with self.lock:
+                    self.followed[os.path.splitext(filename)[0]] = followed
+                thread = Thread(target=self.follow, args=(filename, followed))
+                thread.setDaemon(True)
+                thread.start()
+
+            time.sleep(POLL_SECS)
+
+    def follow(self, filename, followed):
+        try:
+            self.stream(filename, followed)
+        except Exception:
+            logger.exception("streaming remux of '%s' failed", filename)
+        finally:
+            followed.finished.set()
+
+    def stream(self, filename, followed):
+        """ feeds ffmpeg with the growing file until picam moves it away """
+        src_path = os.path.join(self.rec_tmp_dir, filename)
+        dest_path = os.path.join(self.dest_dir, os.path.splitext(filename)[0] + ".mp4")
+        try:
+            src_file = open(src_path, 'rb')
+        except IOError:
+            logger.warn("'%s' has gone before streaming remux started", src_path)
+            return
+
+        cmd = ['ffmpeg', '-y', '-f', 'mpegts', '-i', 'pipe:0'] + COPY_ARGS + FRAGMENTED_MP4_ARGS + [dest_path + PART_SUFFIX]
+        logger.debug("STREAMING CONVERT CMD: %s", cmd)
+        with self.lock:
+            if followed.cancelled:
+                src_file.close()
+                return
+            proc = followed.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+        complete = False
+        last_data = time.time()
+        try:
+            while not followed.cancelled:
+                # checked before reading: the data read after the move is the last one
+                moved = not os.path.exists(src_path)
+                data = src_file.read(READ_CHUNK)
+                if data:
+                    proc.stdin.write(data)
+                    last_data = time.time()
+                elif moved:
+                    complete = True
+                    break
+                elif time.time() - last_data > self.stall_secs:
+                    logger.warn("'%s' has not grown for %d seconds, abandoning streaming remux", src_path, self.stall_secs)
+                    break
+                else:
+                    time.sleep(POLL_SECS)
+        except IOError:
+            logger.exception("streaming remux: ffmpeg has died")
+        finally:
+            src_file.close()
+            proc.stdin.close()
+
+        end = time.time()
+        ret = proc.wait()
+        with self.lock: # cancelled wait() may be remuxing into dest_path by now
+            if complete and ret == 0 and not followed.cancelled:
+                os.rename(dest_path + PART_SUFFIX, dest_path)
+                logger.debug("streamed MP4 ready %f seconds after the end of the recording", (time.time() - end))
+                return
+
+        if ret != 0 and not followed.cancelled:
+            logger.warn("streaming remux of '%s' failed with returncode=%d", src_path, ret)
+        if os.path.exists(dest_path + PART_SUFFIX):
+            os.unlink(dest_path + PART_SUFFIX)
@@ -3,26 +3,146 @@ import json
 import requests
 import time
 import os
-import subprocess
 
-from threading import Thread
-from Queue import Queue, Empty
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from collections import deque
+from threading import Thread, Lock, Condition
+from Queue import Queue, Empty, Full
+
+import videobooth.remux as remux
 
 import logging
 logger = logging.getLogger('videobooth.%s' % __name__)
 
 URL_SUFFIX = ".url"
 DONE_SUFFIX = ".done"
+RETRY_STATUSES = (502, 503, 504)
+STATS_WINDOW = 50 # latencies of the last items reported by the stage
+
+def create_http_session(atende_conf):
+    """
+    requests.Session shared by the create and process workers: connections to the API are kept alive
+    (no TCP+TLS handshake per request). Failed connects are retried with exponential backoff for all
+    requests, gateway errors only for the 'create' POST - the upload body is a stream which can't be resent.
+    """
+    retry = Retry(
+        total=atende_conf['retries'],
+        connect=atende_conf['retries'],
+        read=0,
+        status=atende_conf['retries'],
+        status_forcelist=RETRY_STATUSES,
+        method_whitelist=frozenset(['POST']),
+        backoff_factor=atende_conf['backoff_secs'],
+        raise_on_status=False)
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=atende_conf['pool_size'], max_retries=retry)
+    session = requests.Session()
+    session.headers['X-Token'] = atende_conf['api_token']
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def save_upload_url(filepath, upload_url):
+    with open(filepath + URL_SUFFIX, "w") as f:
+        f.write(upload_url)
+
+
+class Stage(object):
+    """
+    Pool of worker threads consuming a bounded queue. Keeps the counters for monitoring:
+    queue depth, items in progress, done/failed and the latencies (waiting in the queue, processing).
+    func returns True on success, on_finished is called after every item.
+    """
+    def __init__(self, name, func, workers, queue_size, on_finished):
+        self.name = name
+        self.func = func
+        self.on_finished = on_finished
+        self.queue = Queue(maxsize=queue_size)
+        self.threads = [Thread(target=self.worker, name="%s-%d" % (name, num)) for num in xrange(workers)]
+        for thread in self.threads:
+            thread.setDaemon(True)
+
+        self.lock = Lock()
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.wait_times = deque(maxlen=STATS_WINDOW)
+        self.work_times = deque(maxlen=STATS_WINDOW)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item, block=True):
+        """ raises Full if block is False and the queue is full """
+        self.queue.put((time.time(), item), block)
+
+    def join(self):
+        self.queue.join()
+
+    def worker(self):
+        while True:
+            (queued, item) = self.queue.get()
+            start = time.time()
+            with self.lock:
+                self.active += 1
+                self.wait_times.append(start - queued)
+
+            try:
+                success = self.func(*item)
+            except Exception:
+                logger.exception("%s: unhandled exception", self.name)
+                success = False
+
+            with self.lock:
+                self.active -= 1
+                self.work_times.append(time.time() - start)
+                if success:
+                    self.done += 1
+                else:
+                    self.failed += 1
+            self.on_finished()
+            self.queue.task_done()
+
+    def get_stats(self):
+        """ counters and average/max latencies (in seconds) of the last STATS_WINDOW items """
+        with self.lock:
+            stats = {
+                'queued': self.queue.qsize(),
+                'active': self.active,
+                'done': self.done,
+                'failed': self.failed,
+            }
+            for (name, times) in (('wait', self.wait_times), ('work', self.work_times)):
+                stats[name + '_avg'] = sum(times) / len(times) if times else 0.
+                stats[name + '_max'] = max(times) if times else 0.
+        return stats
+
 
 class UploadProxy(object):
     def __init__(self, config):
         self.conf = config
         self.is_running = False
 
-        # file encoding + upload file thread
-        self.process_req = Queue(maxsize=0)
-        self.thread_process = Thread(target=self.process_worker)
-        self.thread_process.setDaemon(True)
+        # movie processing pipeline: remuxing .ts to .mp4 never waits for the network
+        proc_conf = self.conf['process']
+        self.remux_stage = Stage("remux", self.remux_movie, proc_conf['remux_workers'],
+                                 proc_conf['remux_queue_size'], self.save_stats)
+        self.upload_stage = Stage("upload", self.upload_movie, proc_conf['upload_workers'],
+                                  proc_conf['upload_queue_size'], self.save_stats)
+        self.stats_lock = Lock()
+
+        # remuxed movies not fitting into the upload queue, fed to it as the upload slots free up
+        self.upload_backlog = deque()
+        self.backlog_cond = Condition()
+        self.thread_backlog = Thread(target=self.backlog_worker)
+        self.thread_backlog.setDaemon(True)
+
+        self.stream_remux = None
+        if proc_conf['streaming_remux']:
+            self.stream_remux = remux.StreamingRemux(os.path.join(self.conf['picam']['workdir'], "rec/tmp"),
+                                                     self.conf['picam']['archive_dir'], proc_conf['stream_stall_secs'])
 
         if not self.conf['upload']['enabled']:
             return
@@ -30,6 +150,8 @@ class UploadProxy(object):
         if self.conf['upload']['debug']:
             self.enable_debug()
 
+        self.http = create_http_session(self.conf['upload']['atende'])
+
         # create post thread
         self.create_req = Queue(maxsize=8)
         self.create_resp = Queue(maxsize=8)
@@ -62,12 +184,19 @@ class UploadProxy(object):
 
     def start(self):
         self.is_running = True
-        self.thread_process.start()
+        self.remux_stage.start()
+        if self.stream_remux:
+            self.stream_remux.start()
         if self.conf['upload']['enabled']:
+            self.upload_stage.start()
+            self.thread_backlog.start()
             self.thread_create.start()
 
             if self.conf['upload']['retrying']:
-                self.upload_pending_movies()
+                # the upload queue is bounded - scheduling may wait for the uploads
+                thread_pending = Thread(target=self.upload_pending_movies)
+                thread_pending.setDaemon(True)
+                thread_pending.start()
 
     def async_create_post(self, mov_suffix):
         if not self.conf['upload']['enabled']:
@@ -85,7 +214,33 @@ class UploadProxy(object):
             return None
 
     def async_process(self, upload_url, filename):
-        self.process_req.put((upload_url, filename))
+        """ .ts files are remuxed first, .mp4 files (retrying) go straight to the upload """
+        if os.path.splitext(filename)[1] == ".ts":
+            self.remux_stage.put((upload_url, filename))
+        elif self.conf['upload']['enabled']:
+            self.upload_stage.put((upload_url, filename))
+
+    def get_stats(self):
+        """ per-stage queue depth, counters and latencies """
+        stats = {
+            'remux': self.remux_stage.get_stats(),
+            'upload': self.upload_stage.get_stats(),
+        }
+        stats['upload']['backlog'] = len(self.upload_backlog)
+        return stats
+
+    def save_stats(self):
+        """ stats as JSON in archive_dir, so it's served by the webserver (/mov/<stats_file>) """
+        stats = self.get_stats()
+        logger.debug("processing stats: %s", stats)
+        if not self.conf['process']['stats_file']:
+            return
+
+        stats_path = os.path.join(self.conf['picam']['archive_dir'], self.conf['process']['stats_file'])
+        with self.stats_lock:
+            with open(stats_path + ".tmp", "w") as stats_file:
+                json.dump(stats, stats_file)
+            os.rename(stats_path + ".tmp", stats_path)
 
 
     def sync_create_post(self, mov_suffix):
@@ -94,19 +249,17 @@ class UploadProxy(object):
 
         try:
             start = time.time()
-            resp = requests.post(
+            resp = self.http.post(
                 '%s/api/v1/videos/create/' % self.conf['upload']['atende']['api_endpoint'],
                 {
                     'category': self.conf['upload']['atende']['category_id'],
                     'name': name,
                     'description': self.conf['upload']['atende']['description'],
                 },
-                headers={
-                    'X-Token': self.conf['upload']['atende']['api_token']
-                },
                 timeout=self.conf['upload']['atende']['timeout_secs'])
 
             logger.debug("create time: %f seconds", (time.time() - start))
+            resp.raise_for_status()
             resp_json = json.loads(resp.content)
             return (
                 resp_json['uploadUri'],
@@ -128,78 +281,101 @@ class UploadProxy(object):
             logger.debug("create_worker: END")
 
 
-    def process_worker(self):
-        while self.is_running:
-            (upload_url, filepath) = self.process_req.get()
-            logger.debug("process_worker: START")
-            start = time.time()
-
-            # (1) convert mpeg-ts to MP4:
-            (tmp_filepath, ext) = os.path.splitext(filepath)
-            if ext == ".ts":
-                (_, filename) = os.path.split(tmp_filepath)
-                new_filepath = os.path.join(self.conf['picam']['archive_dir'], filename + ".mp4")
-                cmd = ['ffmpeg', '-i', filepath, '-c:v', 'copy', '-c:a', 'copy', '-bsf:a', 'aac_adtstoasc', new_filepath]
-                logger.debug("CONVERT CMD: %s", cmd)
-                subprocess.call(cmd)
-                logger.debug("creating MP4 took %f seconds", (time.time() - start))
-                os.unlink(filepath) # NOTE: removing original .ts file
-                filepath = new_filepath
-
-            if not self.conf['upload']['enabled']:
-                logging.warn("not uploading file: uploading is disabled")
-                self.process_req.task_done()
-                continue
-
-            # (2) only when reuploading at startup - create upload URL synchronously
-            if upload_url is None:
-                # generate mov_prefix similar to strftime
-                fn = os.path.splitext(os.path.split(filepath)[1])[0]
-                (fn_date, fn_time) = fn.split('_')
-                mov_prefix = fn_date + " " + fn_time.replace("-", ":")
-
-                logger.debug("upload uri is None, getting new one(mov_prefix='%s')", mov_prefix)
-                (upload_url, _) = self.sync_create_post(mov_prefix)
-
-            if len(upload_url) == 0:
-                logging.warn("not uploading file: empty post url")
-                continue
-
-            # (3) save upload URL in case it wasn't done already
-            if not os.path.exists(filepath + URL_SUFFIX):
-                with open(filepath + URL_SUFFIX, "w") as f:
-                    f.write(upload_url)
-
-            # (4) upload
-            try:
-                logger.debug("uploading file '%s' to '%s'", filepath, upload_url)
-                start = time.time()
-                with open(filepath, 'rb') as file_obj:
-                    resp = requests.put(
-                        '%s%s' % (self.conf['upload']['atende']['api_endpoint'], upload_url),
-                        data=file_obj,
-                        headers={
-                            'X-Token': self.conf['upload']['atende']['api_token'],
-                            'Content-Type': 'video/mp4'
-                        },
-                        timeout=self.conf['upload']['atende']['timeout_secs'])
-
-                if resp.status_code == 204:
-                    logger.info("upload sucessful")
-                else:
-                    import pprint
-                    logger.warn("Failed upload response: %s", pprint.pformat(resp.__dict__))
-                    resp.raise_for_status()
-
-                # (5) save upload URL in case it wasn't done already:
-                with open(filepath + DONE_SUFFIX, "w") as f:
-                    f.write("%f" % (time.time()-start))
+    def remux_movie(self, upload_url, filepath):
+        """ converts mpeg-ts to MP4 (unless done while recording) and passes it to the upload stage """
+        start = time.time()
+        (_, filename) = os.path.split(os.path.splitext(filepath)[0])
+        new_filepath = os.path.join(self.conf['picam']['archive_dir'], filename + ".mp4")
+        if self.stream_remux:
+            self.stream_remux.wait(filename)
+
+        if os.path.exists(new_filepath):
+            logger.debug("'%s' has been remuxed while recording (waited %f seconds)", new_filepath, (time.time() - start))
+        else:
+            ret = remux.remux_file(filepath, new_filepath)
+            logger.debug("creating MP4 took %f seconds", (time.time() - start))
+            if ret != 0:
+                logger.warn("remuxing '%s' failed with returncode=%d", filepath, ret)
+                return False
+        os.unlink(filepath) # NOTE: removing original .ts file
 
-                logger.debug("uploading took %f seconds", (time.time() - start))
-
-            except requests.exceptions.RequestException:
-                logger.exception("upload: exception")
-
-            self.process_req.task_done()
-            logger.debug("upload_worker: END")
+        if not self.conf['upload']['enabled']:
+            logging.warn("not uploading file: uploading is disabled")
+        else:
+            # the QR code with this post is already printed - keep the URL for retrying after restart
+            if upload_url:
+                save_upload_url(new_filepath, upload_url)
+            self.queue_upload(upload_url, new_filepath)
+        return True
+
+    def queue_upload(self, upload_url, filepath):
+        """ never blocks: when the upload queue is full the movie waits in the backlog """
+        with self.backlog_cond:
+            if not self.upload_backlog:
+                try:
+                    self.upload_stage.put((upload_url, filepath), block=False)
+                    return
+                except Full:
+                    pass
+            logger.info("upload queue full: '%s' waits in the backlog", filepath)
+            self.upload_backlog.append((upload_url, filepath))
+            self.backlog_cond.notify()
+
+    def backlog_worker(self):
+        while True:
+            with self.backlog_cond:
+                while not self.upload_backlog:
+                    self.backlog_cond.wait()
+                item = self.upload_backlog.popleft()
+            self.upload_stage.put(item)
+
+    def upload_movie(self, upload_url, filepath):
+        """ uploads the MP4 file, returns True on success """
+        # (1) only when reuploading at startup - create upload URL synchronously
+        if upload_url is None:
+            # generate mov_prefix similar to strftime
+            fn = os.path.splitext(os.path.split(filepath)[1])[0]
+            (fn_date, fn_time) = fn.split('_')
+            mov_prefix = fn_date + " " + fn_time.replace("-", ":")
+
+            logger.debug("upload uri is None, getting new one(mov_prefix='%s')", mov_prefix)
+            (upload_url, _) = self.sync_create_post(mov_prefix)
+
+        if len(upload_url) == 0:
+            logging.warn("not uploading file: empty post url")
+            return False
+
+        # (2) save upload URL in case it wasn't done already
+        if not os.path.exists(filepath + URL_SUFFIX):
+            save_upload_url(filepath, upload_url)
+
+        # (3) upload
+        try:
+            logger.debug("uploading file '%s' to '%s'", filepath, upload_url)
+            start = time.time()
+            with open(filepath, 'rb') as file_obj:
+                resp = self.http.put(
+                    '%s%s' % (self.conf['upload']['atende']['api_endpoint'], upload_url),
+                    data=file_obj,
+                    headers={
+                        'Content-Type': 'video/mp4'
+                    },
+                    timeout=self.conf['upload']['atende']['timeout_secs'])
+
+            if resp.status_code == 204:
+                logger.info("upload sucessful")
+            else:
+                import pprint
+                logger.warn("Failed upload response: %s", pprint.pformat(resp.__dict__))
+                resp.raise_for_status()
+
+            # (4) mark the file as uploaded
+            with open(filepath + DONE_SUFFIX, "w") as f:
+                f.write("%f" % (time.time()-start))
+
+            logger.debug("uploading took %f seconds", (time.time() - start))
+            return True
 
+        except requests.exceptions.RequestException:
+            logger.exception("upload: exception")
+            return False